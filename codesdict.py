@@ -16,7 +16,11 @@
 """
 
 
+import collections
+import difflib
 import pprint
+import sqlite3
+import time
 
 class KeyCodes(object):
     """Class to read standard codes from the GEDCOM Definition and
@@ -254,6 +258,20 @@ class FamilyCodes(object):
                 familynames = []
         return
 
+    def readgedcom(self, gedcom):
+        """Fill the family dictionary from the family index of a parsed
+           Gedcom, with entries in the same form as readfam."""
+        index = gedcom.family_index()
+        for fam in index.families():
+            familynames = []
+            for role, members in (('HUSB', index.husbands(fam)), ('WIFE', index.wives(fam)),
+                                  ('CHIL', index.children(fam))):
+                for member in members:
+                    familynames.append(member.strip('@') + ' ' + role)
+            familynames.reverse()
+            self.famcode[fam.strip('@')] = familynames
+        return
+
     def reverse_dict(self, dictionary):
         """Invert the family dictionary so that Individuals become keys and Family, the value."""
         reverse_dict = {}
@@ -272,17 +290,215 @@ class FamilyCodes(object):
         """Return the fomatted codes and explanatory text"""
         return pprint.pformat(self.famcode)
 
-class PlaceCodes():
-    def __init__(self):
+class PlaceCodes(object):
+    """Class to hold the coordinates of places already geocoded in this run,
+       keeping only the most recently used places if given a size."""
+    def __init__(self, size=None):
         """Create dictionary"""
+        self.size = size
+        self.placecodes = collections.OrderedDict()
+        self.evictions = 0
+
+    def lookupplace(self, place):
+        """Return the (latitude, longitude) of a place, or None if it hasn't been geocoded."""
+        coords = self.placecodes.pop(place, None)
+        if coords is not None:
+            self.placecodes[place] = coords
+        return coords
+
+    def addcode(self, place, coords):
+        """Store the (latitude, longitude) of a place."""
+        self.placecodes.pop(place, None)
+        if self.size is not None and len(self.placecodes) >= self.size:
+            self.placecodes.popitem(last=False)
+            self.evictions += 1
+        self.placecodes[place] = tuple(coords)
+
+    def addcodes(self, positions):
+        """Store the (latitude, longitude) of each of a list of (place, coords)."""
+        for place, coords in positions:
+            self.addcode(place, coords)
+
+
+class PlaceIndex(object):
+    """Class to find the known place most like a misspelt place. Candidates
+       share the most trigrams with it, their first comma-separated part must
+       be similar to the first part of the place, and their later parts must
+       be the same, so that a place is never matched in another region. A
+       place of one part has no region to check, so it is never matched."""
+
+    # Dice coefficient of the trigrams of the whole place that a candidate
+    # needs before its parts are compared. It only keeps the comparisons
+    # down, so it is set low enough to let through almost any place whose
+    # first part is similar enough and whose later parts are the same.
+    PREFILTER = 0.5
+
+    def __init__(self, similarity=0.85):
+        """Create the index"""
+        self.similarity = similarity
         self.placecodes = {}
+        self.sizes = {}
+        self.trigrams = {}
+
+    def addcode(self, place, coords):
+        """Add the (latitude, longitude) of a place to the index."""
+        if place not in self.placecodes:
+            trigrams = self.__trigrams(place)
+            for trigram in trigrams:
+                self.trigrams.setdefault(trigram, set()).add(place)
+            self.sizes[place] = len(trigrams)
+        self.placecodes[place] = tuple(coords)
 
     def lookupplace(self, place):
-        """Return an explanatory text for a code, or if the code doesn't exist, return 'Unknown' """
-        return self.placecodes.get(place, (0,0))
+        """Return the (place, (latitude, longitude)) of the known place most
+        like a place, or None if none is similar enough."""
+        trigrams = self.__trigrams(place)
+        shared = collections.Counter()
+        for trigram in trigrams:
+            shared.update(self.trigrams.get(trigram, ()))
+        parts = [part.strip() for part in place.split(',')]
+        candidates = []
+        for candidate, count in shared.iteritems():
+            dice = 2.0 * count / (len(trigrams) + self.sizes[candidate])
+            if dice >= self.PREFILTER:
+                candidates.append((dice, candidate))
+        for dice, candidate in sorted(candidates, reverse=True):
+            if self.__partsmatch(parts, [part.strip() for part in candidate.split(',')]):
+                return candidate, self.placecodes[candidate]
+        return None
+
+    def __partsmatch(self, parts, candidateparts):
+        """Return True if the first part of a place is like the first part of
+        a candidate and the later parts, of which there must be at least one,
+        are the same."""
+        if len(parts) < 2 or parts[1:] != candidateparts[1:]:
+            return False
+        return parts[0] == candidateparts[0] or \
+            difflib.SequenceMatcher(None, parts[0], candidateparts[0]).ratio() >= self.similarity
+
+    def __trigrams(self, place):
+        """Return the set of trigrams of a place."""
+        padded = '  ' + place + ' '
+        return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+
+class PlaceCache(object):
+    """Class to keep geocoded places in a SQLite file so that they are only
+       geocoded once across runs. Places are keyed by the place string and
+       the locator that geocoded them, and a PlaceCodes dictionary holds the
+       most recently used places in memory. Places the locator couldn't find
+       are kept as (0, 0) for ttl seconds before they are tried again."""
+
+    FOUND = 'found'
+    NOTFOUND = 'notfound'
+
+    def __init__(self, filename, locator, ttl=30 * 86400, size=10000, similarity=0.85):
+        """Open or create the cache file for a locator."""
+        self.locator = locator
+        self.ttl = ttl
+        self.placecodes = PlaceCodes(size)
+        self.similarity = similarity
+        self.index = None
+        self.hits = 0
+        self.negatives = 0
+        self.misses = 0
+        self.approximates = 0
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = str
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS places ("
+            "place TEXT NOT NULL, locator TEXT NOT NULL, latitude REAL, longitude REAL, "
+            "status TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (place, locator))")
+        self.connection.commit()
+
+    def prefetch(self, places):
+        """Read the cached coordinates of a set of places with a single query."""
+        places = [place for place in set(places) if self.placecodes.lookupplace(place) is None]
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (place TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM wanted")
+        self.connection.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", [(place,) for place in places])
+        rows = self.connection.execute(
+            "SELECT places.place, latitude, longitude, status FROM places JOIN wanted ON places.place = wanted.place "
+            "WHERE locator = ? AND (status = ? OR updated > ?)", (self.locator, self.FOUND, time.time() - self.ttl))
+        count = 0
+        for place, latitude, longitude, status in rows:
+            self.placecodes.addcode(place, self.__coords(latitude, longitude, status))
+            count += 1
+        return count
 
-    def addcode(self,place,coords):
-        self.placecodes[place] = coords
+    def lookupplace(self, place):
+        """Return the (latitude, longitude) of a place, (0, 0) if the locator
+        recently couldn't find it, or None if it hasn't been geocoded."""
+        coords = self.placecodes.lookupplace(place)
+        if coords is None:
+            row = self.connection.execute(
+                "SELECT latitude, longitude, status FROM places WHERE place = ? AND locator = ? "
+                "AND (status = ? OR updated > ?)",
+                (place, self.locator, self.FOUND, time.time() - self.ttl)).fetchone()
+            if row is not None:
+                coords = self.__coords(*row)
+                self.placecodes.addcode(place, coords)
+        if coords is None:
+            self.misses += 1
+        elif coords == (0, 0):
+            self.negatives += 1
+        else:
+            self.hits += 1
+        return coords
+
+    def addcode(self, place, coords):
+        """Store the (latitude, longitude) of a place, (0, 0) meaning that the locator couldn't find it."""
+        self.addcodes([(place, coords)])
+
+    def addcodes(self, positions):
+        """Store the (latitude, longitude) of each of a list of (place, coords)
+        in a single transaction."""
+        now = time.time()
+        rows = []
+        for place, coords in positions:
+            coords = tuple(coords)
+            status = self.NOTFOUND if coords == (0, 0) else self.FOUND
+            self.placecodes.addcode(place, coords)
+            rows.append((place, self.locator, coords[0], coords[1], status, now))
+        self.connection.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        if self.index is not None:
+            for place, locator, latitude, longitude, status, updated in rows:
+                if status == self.FOUND:
+                    self.index.addcode(place, (latitude, longitude))
+
+    def fuzzyplace(self, place):
+        """Return the (place, (latitude, longitude)) of the cached place most
+        like a place, or None if none is similar enough. The index of the
+        cached places is built on first use."""
+        if self.similarity >= 1:
+            return None
+        if self.index is None:
+            self.index = PlaceIndex(self.similarity)
+            rows = self.connection.execute(
+                "SELECT place, latitude, longitude FROM places WHERE locator = ? AND status = ?",
+                (self.locator, self.FOUND))
+            for known, latitude, longitude in rows:
+                self.index.addcode(known, (latitude, longitude))
+        match = self.index.lookupplace(place)
+        if match is not None:
+            self.approximates += 1
+        return match
+
+    def close(self):
+        """Close the cache file."""
+        self.connection.close()
+
+    def __coords(self, latitude, longitude, status):
+        """Return the coordinates of a row of the cache."""
+        if status == self.NOTFOUND:
+            return (0, 0)
+        return (latitude, longitude)
+
+    def __str__(self):
+        """Return the counts of lookups in the cache"""
+        return "Place cache: %d hits, %d negative hits, %d misses, %d approximate, %d evictions" % (
+            self.hits, self.negatives, self.misses, self.approximates, self.placecodes.evictions)
 
 class ALLDICT(object):
     """Class to hold all dictionaries in order to pass to functions."""
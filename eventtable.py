@@ -0,0 +1,110 @@
+"""
+-------------------------------------------------------------------------------
+ Name:      eventtable.py
+ Purpose:   Module to collect the event rows of a GEDCOM file into the
+            structured NumPy array given to the writers.
+
+            Rows are appended straight into one preallocated buffer per
+            column, grown by doubling, and the widths of the string columns
+            are tracked as the rows arrive, so no pass over the rows is
+            needed to size the fields.
+
+ Author:    agent
+
+ Created:   18/10/2026
+ Copyright: (c) agent 2026
+ Licence:   This work is licensed under the Creative Commons Attribution-NonCommercial 4.0
+            International License. To view a copy of this license,
+            visit http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
+            Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+------------------------------------------------------------------------------
+"""
+#Standard Modules
+import math
+import numpy
+
+#Types of the columns that don't hold strings, by heading.
+COLUMNTYPES = {'Latitude': numpy.float64,
+               'Longitude': numpy.float64,
+               'Year': numpy.int32}
+
+
+class EventTable(object):
+    """Columns of event rows, filled as the rows arrive. Rows are taken a
+    chunk at a time, so that each column is filled and sized by one slice
+    assignment per chunk rather than per cell."""
+
+    def __init__(self, headingslist, capacity=1024, chunk=4096):
+        """Create empty column buffers for the headings."""
+        self.headings = list(headingslist)
+        self.size = 0
+        self.capacity = capacity
+        self.chunk = chunk
+        self.pending = []
+        self.strings = [heading not in COLUMNTYPES for heading in self.headings]
+        self.columns = [numpy.empty(capacity, COLUMNTYPES.get(heading, '|S5')) for heading in self.headings]
+
+    def append(self, row):
+        """Add a row to the end of the columns."""
+        self.pending.append(row)
+        if len(self.pending) >= self.chunk:
+            self.__flush()
+
+    def extend(self, rows):
+        """Add each of an iterator of rows."""
+        for row in rows:
+            self.append(row)
+
+    def array(self):
+        """Return the rows as a structured array with a field per heading."""
+        self.__flush()
+        dts = [(heading, column.dtype) for heading, column in zip(self.headings, self.columns)]
+        inarray = numpy.empty(self.size, numpy.dtype(dts))
+        for heading, column in zip(self.headings, self.columns):
+            inarray[heading] = column[:self.size]
+        return inarray
+
+    def __len__(self):
+        """Return the number of rows."""
+        return self.size + len(self.pending)
+
+    def __flush(self):
+        """Copy the pending rows into the columns, widening string columns
+        to fit them."""
+        rows = self.pending
+        if not rows:
+            return
+        self.pending = []
+        count = len(rows)
+        while self.size + count > self.capacity:
+            self.__grow()
+        for col, values in enumerate(zip(*rows)):
+            column = self.columns[col]
+            if self.strings[col]:
+                values = map(str, values)
+                width = max(map(len, values))
+                if width > column.itemsize:
+                    column = self.columns[col] = column.astype('|S%d' % roundup(width))
+            column[self.size:self.size + count] = values
+        self.size += count
+
+    def __grow(self):
+        """Double the capacity of the column buffers."""
+        self.capacity *= 2
+        for col, column in enumerate(self.columns):
+            grown = numpy.empty(self.capacity, column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[col] = grown
+
+
+def roundup(num):
+    """Returns an integer rounded up."""
+    return int(math.ceil(num / 5.0)) * 5
+
+
+def main():
+    """Main function."""
+    pass
+
+if __name__ == '__main__':
+    main()
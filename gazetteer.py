@@ -0,0 +1,172 @@
+"""
+-------------------------------------------------------------------------------
+ Name:      gazetteer.py
+ Purpose:   Module to geocode place names offline from a local gazetteer.
+
+            The gazetteer is a GeoNames dump (allCountries.txt, cities1000.txt
+            or similar, from http://download.geonames.org/export/dump/).  It
+            is read once into an indexed SQLite file beside it, which later
+            runs open memory-mapped.  If countryInfo.txt and
+            admin1CodesASCII.txt are in the same directory, the country and
+            state of a place are used to choose between places of the same
+            name.
+
+ Author:    agent
+
+ Created:   18/10/2026
+ Copyright: (c) agent 2026
+ Licence:   This work is licensed under the Creative Commons Attribution-NonCommercial 4.0
+            International License. To view a copy of this license,
+            visit http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
+            Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+------------------------------------------------------------------------------
+"""
+#Standard Modules
+import collections
+import os
+import sqlite3
+import threading
+
+# Version of the layout of the index file.
+INDEX_VERSION = 1
+
+# Bytes of the index file mapped into memory.
+MMAP_SIZE = 1 << 30
+
+Location = collections.namedtuple('Location', 'address latitude longitude')
+
+
+class Gazetteer(object):
+    """A locator with the geopy geocode interface answering from an indexed
+    copy of a GeoNames dump."""
+
+    def __init__(self, filename, index=None):
+        """Open the index of a gazetteer, building it first if it is missing
+        or older than the gazetteer."""
+        self.filename = filename
+        if index is None:
+            index = filename + '.sqlite'
+        self.index = index
+        if not self.current():
+            self.build()
+        self.connection = sqlite3.connect(self.index, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+        self.connection.execute("PRAGMA query_only = 1")
+        self.lock = threading.Lock()
+        self.countries = dict(self.connection.execute("SELECT code, name FROM regions WHERE code NOT LIKE '%.%'"))
+        self.states = dict(self.connection.execute("SELECT code, name FROM regions WHERE code LIKE '%.%'"))
+
+    def current(self):
+        """Return True if the index exists, is up to date and has this layout."""
+        if not os.path.exists(self.index):
+            return False
+        if os.path.getmtime(self.index) < os.path.getmtime(self.filename):
+            return False
+        connection = sqlite3.connect(self.index)
+        try:
+            return connection.execute("PRAGMA user_version").fetchone()[0] == INDEX_VERSION
+        finally:
+            connection.close()
+
+    def build(self):
+        """Read the gazetteer into a new index file."""
+        print "Building gazetteer index %s" % self.index
+        temp = self.index + '.tmp'
+        if os.path.exists(temp):
+            os.remove(temp)
+        connection = sqlite3.connect(temp)
+        connection.text_factory = str
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(
+            "CREATE TABLE places (key TEXT NOT NULL, latitude REAL, longitude REAL, "
+            "country TEXT, admin1 TEXT, population INTEGER)")
+        connection.execute("CREATE TABLE regions (code TEXT PRIMARY KEY, name TEXT)")
+        connection.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?)", self.readplaces())
+        connection.executemany("INSERT OR REPLACE INTO regions VALUES (?, ?)", self.readregions())
+        connection.execute("CREATE INDEX places_key ON places (key)")
+        connection.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+        connection.commit()
+        connection.close()
+        if os.path.exists(self.index):
+            os.remove(self.index)
+        os.rename(temp, self.index)
+
+    def readplaces(self):
+        """Yield a row for the name, and the ASCII name if it differs, of
+        every place of the gazetteer."""
+        with open(self.filename) as fplaces:
+            for line in fplaces:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 15:
+                    continue
+                row = (float(fields[4]), float(fields[5]), fields[8], fields[10], int(fields[14] or 0))
+                name = fields[1].lower()
+                yield (name,) + row
+                asciiname = fields[2].lower()
+                if asciiname and asciiname != name:
+                    yield (asciiname,) + row
+
+    def readregions(self):
+        """Yield the (code, name) of the countries and states given in
+        countryInfo.txt and admin1CodesASCII.txt, where they exist."""
+        directory = os.path.dirname(self.filename)
+        countries = os.path.join(directory, 'countryInfo.txt')
+        if os.path.exists(countries):
+            with open(countries) as fcountries:
+                for line in fcountries:
+                    fields = line.rstrip('\n').split('\t')
+                    if not line.startswith('#') and len(fields) > 4:
+                        yield (fields[0], fields[4].lower())
+        states = os.path.join(directory, 'admin1CodesASCII.txt')
+        if os.path.exists(states):
+            with open(states) as fstates:
+                for line in fstates:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) > 1:
+                        yield (fields[0], fields[1].lower())
+
+    def geocode(self, query, timeout=None):
+        """Return the Location of a place, or None if it isn't in the
+        gazetteer. The first comma-separated part of the place is looked up;
+        the later parts choose between places of that name by country and
+        state, then population. If the place has later parts and the names
+        of countries and states are known, a place of that name in none of
+        them is not taken, so None is returned."""
+        parts = [part.strip() for part in query.lower().split(',')]
+        parts = [part for part in parts if part]
+        if not parts:
+            return None
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT latitude, longitude, country, admin1, population FROM places WHERE key = ?",
+                (parts[0],)).fetchall()
+        if not rows:
+            return None
+        context = set(parts[1:])
+        best = None
+        for latitude, longitude, country, admin1, population in rows:
+            score = ((self.countries.get(country) in context) +
+                     (self.states.get(country + '.' + admin1) in context), population)
+            if best is None or score > best[0]:
+                best = (score, latitude, longitude)
+        if context and (self.countries or self.states) and best[0][0] == 0:
+            return None
+        return Location(query, best[1], best[2])
+
+    def geocode_batch(self, queries, timeout=None):
+        """Return the Location, or None, of each of a list of places."""
+        return [self.geocode(query, timeout) for query in queries]
+
+    def close(self):
+        """Close the index file."""
+        self.connection.close()
+
+
+def main():
+    """Main function."""
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+-------------------------------------------------------------------------------
+ Name:      gedcombench.py
+ Purpose:   Module to measure the memory use and speed of the GEDCOM parser
+            so that changes to it can be compared against earlier versions.
+
+ Author:    agent
+
+ Created:   18/10/2026
+ Copyright: (c) agent 2026
+ Licence:   This work is licensed under the Creative Commons Attribution-NonCommercial 4.0
+            International License. To view a copy of this license,
+            visit http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
+            Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+------------------------------------------------------------------------------
+"""
+#Standard Modules
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import numpy
+#Project Modules
+import eventtable
+import gedcomparser
+import geocodeplace
+
+
+class LegacyElement:
+    """Element with the original per-instance storage, kept only as a
+    yardstick for the compact gedcomparser.Element."""
+
+    def __init__(self, level, pointer, tag, value, dictionary):
+        """Store the element the way the original parser did."""
+        self.level = level
+        self.pointer = pointer
+        self.tag = tag
+        self.value = value
+        self.dict = dictionary
+        self.children = []
+        self.parent = None
+
+
+def readrows(filename):
+    """Return the (level, pointer, tag, value) of every element of a file."""
+    return [(elem.level(), elem.pointer(), elem.tag(), elem.value())
+            for elem in gedcomparser.Gedcom(filename).element_list()]
+
+
+def buildlegacy(rows):
+    """Build a tree of LegacyElements from parsed rows."""
+    elements = []
+    dictionary = {}
+    stack = [LegacyElement(-1, "", "TOP", "", dictionary)]
+    for level, pointer, tag, value in rows:
+        elem = LegacyElement(level, pointer, tag, value, dictionary)
+        del stack[level + 1:]
+        stack[-1].children.append(elem)
+        elem.parent = stack[-1]
+        stack.append(elem)
+        elements.append(elem)
+        if pointer != '':
+            dictionary[pointer] = elem
+    return elements
+
+
+def buildcompact(rows):
+    """Build a tree of gedcomparser.Elements from parsed rows."""
+    elements = []
+    dictionary = {}
+    stack = [gedcomparser.Element(-1, "", "TOP", "", dictionary)]
+    for level, pointer, tag, value in rows:
+        elem = gedcomparser.Element(level, pointer, intern(tag), value, dictionary)
+        del stack[level + 1:]
+        stack[-1].add_child(elem)
+        elem.add_parent(stack[-1])
+        stack.append(elem)
+        elements.append(elem)
+        if pointer != '':
+            dictionary[pointer] = elem
+    return elements
+
+
+def legacysize(elem):
+    """Bytes held by a LegacyElement itself, excluding its strings."""
+    return sys.getsizeof(elem) + sys.getsizeof(elem.__dict__) + sys.getsizeof(elem.children)
+
+
+def compactsize(elem):
+    """Bytes held by a compact Element itself, excluding its strings."""
+    size = sys.getsizeof(elem)
+    if elem.children():
+        size += sys.getsizeof(elem.children())
+    return size
+
+
+def elementmemory(filename):
+    """Report memory per line and construction time of the compact
+    Element against the original per-instance layout."""
+    rows = readrows(filename)
+    lines = len(rows)
+    for label, build, size in (("legacy", buildlegacy, legacysize),
+                               ("compact", buildcompact, compactsize)):
+        start = time.time()
+        elements = build(rows)
+        elapsed = time.time() - start
+        total = sum(size(elem) for elem in elements)
+        print "%-8s %8.1f bytes/line %10.0f lines/sec" % (
+            label, float(total) / lines, lines / max(elapsed, 1e-9))
+        del elements
+
+
+def parsethroughput(filename, repeat=3):
+    """Report how many lines per second the Gedcom parser reads, taking
+    the best of several runs."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        lines = len(gedcomparser.Gedcom(filename).element_list())
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "parse    %8d lines %10.0f lines/sec" % (lines, lines / max(best, 1e-9))
+
+
+def writesynthetic(filename, records):
+    """Write a synthetic Gedcom file with the given number of individual
+    records, each with a name, birth, death and family."""
+    with open(filename, 'w') as f:
+        f.write("0 HEAD\n1 CHAR UTF-8\n")
+        for i in xrange(1, records + 1):
+            f.write("0 @P%d@ INDI\n1 NAME John/Smith%d/\n1 SEX M\n"
+                    "1 BIRT\n2 DATE 12 JAN %d\n2 PLAC Sydney, NSW, Australia\n"
+                    "1 DEAT\n2 DATE %d\n2 PLAC Farm, Parish, Lancashire, England\n"
+                    "1 FAMS @F%d@\n" % (i, i % 97, 1800 + i % 100, 1860 + i % 100, (i + 1) / 2))
+        f.write("0 TRLR\n")
+
+
+def parallelscaling(records):
+    """Report the parse time of a synthetic file of the given number of
+    records for each number of worker processes up to the core count."""
+    handle, filename = tempfile.mkstemp(suffix='.ged')
+    os.close(handle)
+    try:
+        writesynthetic(filename, records)
+        baseline = None
+        workers = 1
+        while True:
+            start = time.time()
+            lines = len(gedcomparser.Gedcom(filename, workers=workers).element_list())
+            elapsed = time.time() - start
+            if baseline is None:
+                baseline = elapsed
+            print "workers %2d %8d lines %8.2f sec %6.2fx" % (
+                workers, lines, elapsed, baseline / max(elapsed, 1e-9))
+            if workers >= multiprocessing.cpu_count():
+                break
+            workers = min(workers * 2, multiprocessing.cpu_count())
+    finally:
+        os.remove(filename)
+
+
+def geocodescaling(places, latency=0.05, rate=None):
+    """Report the geocoding throughput of a stub locator with injected
+    latency for increasing numbers of threads."""
+    queries = ["Place %d, Parish, County, Country" % i for i in xrange(places)]
+    locator = geocodeplace.GEOCODEPLAC("Stub", rate, stub={'latency': latency})
+    expected = [locator.geocode(query, 'True') for query in queries[:10]]
+    baseline = None
+    for threads in (1, 2, 4, 8, 16):
+        start = time.time()
+        positions = locator.geocodeall(queries, 'True', threads)
+        elapsed = time.time() - start
+        assert positions[:10] == expected, "threads %2d returned positions out of order" % threads
+        if baseline is None:
+            baseline = elapsed
+            ordered = positions
+        assert positions == ordered, "threads %2d returned positions out of order" % threads
+        print "threads %2d %6d places %8.1f places/sec %6.2fx" % (
+            threads, places, places / max(elapsed, 1e-9), baseline / max(elapsed, 1e-9))
+
+
+def pipelinebench(filename, latency=0.05, errors=0.0, rate=None, threads=4):
+    """Report the time geogedcom takes to read and geocode a Gedcom file
+    with the Stub locator, starting with an empty place cache."""
+    import geogedcom
+    handle, placecache = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    argv = sys.argv
+    sys.argv = [argv[0], '-c', filename, '-l', 'Stub', '-d', placecache, '-t', str(threads),
+                '--stublatency', str(latency), '--stuberrors', str(errors)]
+    if rate is not None:
+        sys.argv += ['--stubrate', str(rate)]
+    try:
+        start = time.time()
+        family = geogedcom.MyFamily()
+        family.readindividuals(family.locator, family.geocodeflag)
+        elapsed = time.time() - start
+    finally:
+        sys.argv = argv
+        os.remove(placecache)
+    print "pipeline %8d rows %8.2f sec %8.1f rows/sec" % (
+        len(family.indiplacelist), elapsed, len(family.indiplacelist) / max(elapsed, 1e-9))
+
+
+TABLEHEADINGS = ["Long", "Lat", "Individual", "GivenNames", "FamilyName", "Family", "Date", "Year",
+                 "Place", "Event", "Source", "Longitude", "Latitude", "IndiSortOrder", "YearSortOrder",
+                 "Approximate"]
+
+
+def eventrows(filename):
+    """Return rows like those geogedcom writes for each event of each
+    individual of a Gedcom file."""
+    rows = []
+    for elem in gedcomparser.Gedcom(filename).individuals():
+        (first, last) = elem.name()
+        for event in elem.events():
+            rows.append((151.21, -33.87, elem.indi(), first, last, 'F1', event.date, event.year,
+                         event.place, event.tag, ', '.join(event.sources), 151.21, -33.87,
+                         elem.indi().replace('P', '').zfill(5), 10, 'No'))
+    return rows
+
+
+def legacytable(rows, headingslist):
+    """Build the structured array the way writetofc originally did: size
+    every column with str() of every cell, then convert the row list."""
+    maxlen = []
+    for col in xrange(len(headingslist)):
+        maxlen.append(eventtable.roundup(max(len(str(row[col])) for row in rows)))
+    dts = []
+    for col, heading in enumerate(headingslist):
+        typ = "|S" + str(maxlen[col])
+        if heading == 'Latitude' or heading == 'Longitude':
+            typ = "<f8"
+        elif heading == "Year":
+            typ = numpy.int32
+        dts.append((heading, typ))
+    return numpy.array(rows, numpy.dtype(dts))
+
+
+def tablebench(filename):
+    """Report how long building the event array takes with the EventTable
+    against the original list of tuples and maxitemlength."""
+    rows = eventrows(filename)
+    start = time.time()
+    legacy = legacytable(rows, TABLEHEADINGS)
+    middle = time.time()
+    table = eventtable.EventTable(TABLEHEADINGS)
+    table.extend(iter(rows))
+    compact = table.array()
+    end = time.time()
+    if legacy.tolist() != compact.tolist():
+        print "table    arrays differ"
+    print "legacy   %8d rows %8.3f sec" % (len(rows), middle - start)
+    print "table    %8d rows %8.3f sec" % (len(rows), end - middle)
+
+
+def parse_options():
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Benchmarks for python-geogedcom.")
+    parser.add_argument('filename', nargs='?', help="Name of Gedcom file")
+    parser.add_argument(
+                        '-s', '--scaling', required=False, type=int, default=0, dest='records',
+                        help="Number of records in a synthetic file used to measure parallel parsing.")
+    parser.add_argument(
+                        '-g', '--geocode', required=False, type=int, default=0, dest='places',
+                        help="Number of places geocoded by a stub locator to measure concurrent geocoding.")
+    parser.add_argument(
+                        '-r', '--rate', required=False, type=float, default=None, dest='rate',
+                        help="Requests per second allowed to the stub locator.")
+    parser.add_argument(
+                        '-p', '--pipeline', required=False, action='store_true', dest='pipeline',
+                        help="Time geogedcom reading the Gedcom file with the stub locator.")
+    parser.add_argument(
+                        '-b', '--table', required=False, action='store_true', dest='table',
+                        help="Time building the event array from the events of the Gedcom file.")
+    parser.add_argument(
+                        '-e', '--errors', required=False, type=float, default=0.0, dest='errors',
+                        help="Fraction of requests the stub locator fails in the pipeline benchmark.")
+    parser.add_argument(
+                        '-t', '--threads', required=False, type=int, default=4, dest='threads',
+                        help="Number of threads geocoding in the pipeline benchmark.")
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks against a Gedcom file."""
+    options = parse_options()
+    if options.filename and options.table:
+        tablebench(options.filename)
+    elif options.filename and options.pipeline:
+        pipelinebench(options.filename, errors=options.errors, rate=options.rate, threads=options.threads)
+    elif options.filename:
+        elementmemory(options.filename)
+        parsethroughput(options.filename)
+    if options.records:
+        parallelscaling(options.records)
+    if options.places:
+        geocodescaling(options.places, rate=options.rate)
+
+if __name__ == '__main__':
+    main()
@@ -40,10 +40,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ["Gedcom", "Element", "GedcomParseError"]
+__all__ = ["Gedcom", "LazyGedcom", "Element", "Summary", "Event", "FamilyIndex", "Query",
+           "GedcomParseError"]
 
 # Global imports
+import collections
+import hashlib
+import marshal
+import mmap
+import multiprocessing
+import os
+import re
 import string
+try:
+    import numpy
+except ImportError:
+    numpy = None
+#Project Modules
+import gedcomreader
 
 class Gedcom:
     """Gedcom parser
@@ -54,17 +68,60 @@ class Gedcom:
     file), or a dictionary (the key to the dictionary is a unique
     identifier that one element can use to point to another element).
 
+    The parsed elements can be kept in a cache file, either next to the
+    Gedcom file or in a cache directory, so that later runs against the
+    same file load them with one read instead of parsing it again.  The
+    cache is used while the size and modification time of the file are
+    unchanged, or failing that while its content hash is unchanged, and
+    is rebuilt otherwise.
+
+    Large files can be parsed by several processes at once.  The file
+    is cut into chunks at level-0 lines, each chunk is tokenized by a
+    worker process, and the rows are linked into one element tree in
+    file order, so the result is the same as parsing in one process.
+
     """
 
-    def __init__(self,file):
-        """Initialize a Gedcom parser. You must supply a Gedcom file."""
-        self.__element_list = []
-        self.__element_dict = {}
-        self.__element_top = Element(-1, "", "TOP", "", self.__element_dict)
-        self.__current_level = -1
-        self.__current_element = self.__element_top
-        self.__individuals = 0
-        self.__parse(file)
+    # Bumped whenever the layout of the cache files changes.
+    CACHE_VERSION = 2
+
+    def __init__(self,file,cache=None,workers=1):
+        """Initialize a Gedcom parser. You must supply a Gedcom file,
+        or None for a parser that has not read anything yet.  Set cache
+        to True to cache the parsed file next to it, or to the name of
+        a directory to cache it there.  Set workers to the number of
+        processes that should share the parsing.
+
+        """
+        self.__reset()
+        self.__workers = workers
+        if file is None:
+            return
+        if not cache:
+            self.__parse(file)
+            return
+        if cache is True:
+            path = file + '.gcache'
+        else:
+            name = hashlib.sha1(os.path.abspath(file)).hexdigest()[:12]
+            path = os.path.join(cache, os.path.basename(file) + '.' + name + '.gcache')
+        if not self.__load_cache(file, path):
+            self.__parse(file)
+            self.__save_cache(file, path)
+
+    @classmethod
+    def iter_records(cls, file):
+        """Yield each level-0 record (INDI, FAM, SOUR...) of a Gedcom
+        file as a complete element subtree, one record at a time.
+
+        Records are dropped by the parser as soon as the next one
+        starts, so memory stays roughly constant whatever the size of
+        the file.  Pointers are only resolved within the record being
+        yielded, so lookups into other records such as families()
+        return nothing in this mode.
+
+        """
+        return cls(None).__stream(file)
 
     def element_list(self):
         """Return a list of all the elements in the Gedcom file.  The
@@ -81,143 +138,766 @@ class Gedcom:
         """
         return self.__element_dict
 
+    def records(self, tag):
+        """Return a list of the level-0 records with the given tag (INDI,
+        FAM, SOUR...), in the order they appeared in the Gedcom file.
+
+        """
+        return self.__records.get(tag, [])
+
+    def individuals(self):
+        """Return a list of the individual (INDI) records."""
+        return self.records("INDI")
+
+    def families(self):
+        """Return a list of the family (FAM) records."""
+        return self.records("FAM")
+
+    def sources(self):
+        """Return a list of the source (SOUR) records."""
+        return self.records("SOUR")
+
+    def family_index(self):
+        """Return the FamilyIndex of the individual and family records,
+        built on first use.
+
+        """
+        if self.__family_index is None:
+            self.__family_index = FamilyIndex(self.individuals(), self.families())
+        return self.__family_index
+
+    def compile_query(self, criteria):
+        """Return a Query for a colon-separated criteria string (see
+        Element.criteria_match), parsed once so that it can be used on
+        many elements.
+
+        """
+        return Query(criteria)
+
+    def select(self, query):
+        """Return the individuals matching a Query or criteria string, in
+        file order.
+
+        The year criteria are checked for the whole population at once
+        against integer columns of birth, death and marriage years, which
+        are worked out from the individuals the first time select() is
+        used.  NumPy is used for this when it is installed.  The name
+        criteria are then checked on the remaining individuals only.
+
+        The year columns are kept for later calls, and are worked out
+        again once an element has been added anywhere in the tree with
+        add_child().
+
+        """
+        if not isinstance(query, Query):
+            query = self.compile_query(query)
+        if not query.valid:
+            return []
+        people = self.individuals()
+        # adding an element forgets the summary of the top element, so a
+        # new summary means the columns are out of date
+        stamp = self.__element_top.summary()
+        if self.__years is None or self.__years_stamp is not stamp:
+            self.__years = self.__year_columns(people)
+            self.__years_stamp = stamp
+        if numpy is not None:
+            mask = numpy.ones(len(people), dtype=bool)
+            for key, year1, year2 in query.years:
+                if key == "marriage":
+                    owners, years = self.__years[key]
+                    found = numpy.zeros(len(people), dtype=bool)
+                    found[owners[(years >= year1) & (years <= year2)]] = True
+                    mask &= found
+                else:
+                    years = self.__years[key]
+                    mask &= (years >= year1) & (years <= year2)
+            candidates = [people[i] for i in numpy.flatnonzero(mask)]
+        else:
+            keep = range(len(people))
+            for key, year1, year2 in query.years:
+                if key == "marriage":
+                    owners, years = self.__years[key]
+                    found = set(owner for owner, year in zip(owners, years)
+                                if year >= year1 and year <= year2)
+                    keep = [i for i in keep if i in found]
+                else:
+                    years = self.__years[key]
+                    keep = [i for i in keep if years[i] >= year1 and years[i] <= year2]
+            candidates = [people[i] for i in keep]
+        return [e for e in candidates if query.names_match(e)]
+
     # Private methods
 
+    def __file_key(self, file, digest=False):
+        """Return the (size, mtime) of a file, and its content hash as
+        well if digest is True."""
+        info = os.stat(file)
+        if not digest:
+            return info.st_size, info.st_mtime
+        sha = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                sha.update(block)
+        return info.st_size, info.st_mtime, sha.hexdigest()
+
+    def __load_cache(self, file, path):
+        """Build the elements from a cache file, returning False if there
+        is no usable cache for the Gedcom file."""
+        try:
+            with open(path, 'rb') as f:
+                version, size, mtime, digest, rows = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+        if version != self.CACHE_VERSION:
+            return False
+        key = self.__file_key(file)
+        if key != (size, mtime):
+            # touched but possibly unchanged, so compare the contents
+            key = self.__file_key(file, True)
+            if key[0] != size or key[2] != digest:
+                return False
+        self.__build(*rows)
+        if key[1] != mtime:
+            self.__save_cache(file, path, key)
+        return True
+
+    def __save_cache(self, file, path, key=None):
+        """Write the parsed elements to a cache file.  A cache that cannot
+        be written is simply skipped."""
+        if key is None:
+            key = self.__file_key(file, True)
+        elements = self.__element_list
+        rows = ([e.level() for e in elements], [e.pointer() for e in elements],
+                [e.tag() for e in elements], [e.value() for e in elements])
+        temp = path + '.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                marshal.dump((self.CACHE_VERSION,) + key + (rows,), f)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            pass
+
+    def __year_columns(self, people):
+        """Work out the birth, death and marriage year columns of the
+        individuals, marriages being held as parallel arrays of the
+        individual's position and the year."""
+        births = []
+        deaths = []
+        owners = []
+        marriages = []
+        for i, e in enumerate(people):
+            births.append(e.birth_year())
+            deaths.append(e.death_year())
+            for year in e.marriage_years():
+                owners.append(i)
+                marriages.append(year)
+        if numpy is not None:
+            births = numpy.array(births, dtype=numpy.int32)
+            deaths = numpy.array(deaths, dtype=numpy.int32)
+            owners = numpy.array(owners, dtype=numpy.intp)
+            marriages = numpy.array(marriages, dtype=numpy.int32)
+        return {"birth": births, "death": deaths, "marriage": (owners, marriages)}
+
+    def __reset(self):
+        """Start a new, empty element tree."""
+        self.__element_list = []
+        self.__element_dict = {}
+        self.__records = {}
+        self.__years = None
+        self.__years_stamp = None
+        self.__family_index = None
+        self.__element_top = Element(-1, "", "TOP", "", self.__element_dict)
+        self.__current_level = -1
+        self.__current_element = self.__element_top
+
+    def __lines(self, file):
+        """Return the numbered lines of a Gedcom file, as UTF-8 text."""
+        return enumerate(gedcomreader.readlines(file), 1)
+
     def __parse(self,file):
-        # open file
+        if self.__workers > 1:
+            self.__parse_parallel(file)
+            return
         # go through the lines
-        #f = open(file, 'r')
-        #print file
-        with open(file, 'r') as f:
-            number = 1
-            for line in f:
-                # Skip over some junk that Rootsmagic puts in gedcom files.
-                if number == 1 and ord(line[0]) == 239:
-                    line = line[3:]
-                self.__parse_line(number, line)
-                number += 1
-            self.__count()
+        for number, line in self.__lines(file):
+            self.__parse_line(number, line)
+
+    def __parse_parallel(self, file):
+        """Parse the file with a pool of worker processes."""
+        with open(file, 'rb') as f:
+            data = f.read()
+        (encoding, start) = gedcomreader.detect(data[:gedcomreader.BLOCK])
+        unit = gedcomreader.width(encoding)
+        newline = gedcomreader.encode('\n', encoding)
+        size = ((len(data) - start) / (self.__workers * 4) / unit + 1) * unit
+        chunks = []
+        number = 1
+        while start < len(data):
+            end = gedcomreader.findrecord(data, encoding, start + size)
+            end = len(data) if end < 0 else end + unit
+            chunks.append((file, start, end, number, encoding))
+            number += data.count(newline, start, end)
+            start = end
+        pool = multiprocessing.Pool(self.__workers)
+        try:
+            results = pool.map(_tokenize_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        for rows in results:
+            self.__build(*rows)
+
+    def __stream(self, file):
+        """Parse a file record by record, yielding each level-0 record
+        once the line starting the next one has been read."""
+        record = None
+        for number, line in self.__lines(file):
+            l, p, t, v = _split_line(number, line)
+            if l == 0:
+                if record is not None:
+                    yield record
+                # forget the previous record before building the next
+                record = None
+                self.__reset()
+            self.__add_element(number, l, p, t, v)
+            if l == 0:
+                record = self.__current_element
+        if record is not None:
+            yield record
 
     def __parse_line(self, number, line):
         """Parses line by splitting into Level, Pointer, Tage and Value"""
-        parts = string.split(line)
-        place = 0
-        l = self.__level(number,parts,place)
-        place += 1
-        p = self.__pointer(number,parts,place)
-        if p != '':
-            place += 1
-        t = self.__tag(number,parts,place)
-        place += 1
-        v = self.__value(number,parts,place)
+        l, p, t, v = _split_line(number, line)
+        self.__add_element(number, l, p, t, v)
 
+    def __add_element(self, number, l, p, t, v):
+        """Creates an element and links it below its parent"""
         # create the element
         if l > self.__current_level + 1:
             self.__error(number, "Structure of GEDCOM file is corrupted")
 
-        e = Element(l,p,t,v,self.element_dict())
+        # tags repeat on every line, so keep a single copy of each
+        e = Element(l,p,intern(t),v,self.element_dict())
         self.__element_list.append(e)
         if p != '':
             self.__element_dict[p] = e
+        if l == 0:
+            self.__records.setdefault(e.tag(), []).append(e)
 
         if l > self.__current_level:
-            self.__current_element.add_child(e)
+            self.__current_element.add_child(e, True)
             e.add_parent(self.__current_element)
         else:
             # l.value <= self.__current_level:
             while (self.__current_element.level() != l - 1):
                 self.__current_element = self.__current_element.parent()
-            self.__current_element.add_child(e)
+            self.__current_element.add_child(e, True)
             e.add_parent(self.__current_element)
 
         # finish up
         self.__current_level = l
         self.__current_element = e
 
-    def __level(self, number, parts, place):
-        """Returns the level part of the file line if it exists"""
-        if len(parts) <= place:
-            self.__error(number, "Empty line")
-        try:
-            l = int(parts[place])
-        except ValueError:
-            self.__error(number, "Line must start with an integer level")
-
-        if (l < 0):
-            self.__error(number, "Line must start with a positive integer")
-
-        return l
-
-    def __pointer(self, number, parts, place):
-        """Returns the pointer part of the file line if it exists"""
-        if len(parts) <= place:
-            self.__error(number, "Incomplete Line")
-        p = ''
-        part = parts[1]
-        if part[0] == '@':
-            if part[len(part)-1] == '@':
-                p = part
-                # could strip the pointer to remove the @ with
-                # string.strip(part,'@')
-                # but it may be useful to identify pointers outside this class
-            else:
-                self.__error(number, "Pointer element must start and end with @")
-        return p
-
-    def __tag(self, number, parts, place):
-        """Returns the tag part of the file line if it exists"""
-
-        if len(parts) <= place:
-            self.__error(number, "Incomplete line")
-        return parts[place]
-
-    def __value(self, number, parts, place):
-        """Returns the value part of the file line if it exists"""
-        if len(parts) <= place:
-            return ''
-        p = self.__pointer(number,parts,place)
-        if p != '':
-            # rest of the line should be empty
-            if len(parts) > place + 1:
-                self.__error(number, "Too many elements")
-            return p
-        else:
-            # rest of the line should be ours
-            vlist = []
-            while place < len(parts):
-                vlist.append(parts[place])
-                place += 1
-            v = string.join(vlist)
-            return v
+    def __build(self, levels, pointers, tags, values):
+        """Links elements from rows already known to be well formed and
+        starting at level 0, as read back from a cache or a worker,
+        without the checks of __add_element"""
+        elements = self.__element_list
+        pointed = self.__element_dict
+        records = self.__records
+        stack = [self.__element_top]
+        for i in xrange(len(levels)):
+            l = levels[i]
+            p = pointers[i]
+            e = Element(l,p,intern(tags[i]),values[i],pointed)
+            elements.append(e)
+            if p != '':
+                pointed[p] = e
+            if l == 0:
+                records.setdefault(e.tag(), []).append(e)
+            del stack[l + 1:]
+            stack[-1].add_child(e, True)
+            e.add_parent(stack[-1])
+            stack.append(e)
+        self.__current_level = stack[-1].level()
+        self.__current_element = stack[-1]
 
     def __error(self, number, text):
         """Raises gedcom file format error"""
 
-        error = "Gedcom format error on line " + str(number) + ': ' + text
-        raise GedcomParseError, error
-
-    def __count(self):
-        """Count number of individuals"""
-        self.__individuals = 0
-        for e in self.__element_list:
-            if e.individual():
-                self.__individuals += 1
+        _error(number, text)
 
     def __print(self):
         for e in self.element_list:
             print string.join([str(e.level()),e.pointer(),e.tag(),e.value()])
 
 
+def _tokenize(data, number):
+    """Tokenize a block of lines, the first being line number, into
+    level, pointer, tag and value columns.  The block must start
+    with a level-0 line."""
+    lines = data.split('\n')
+    if data.endswith('\n'):
+        lines.pop()
+    levels = []
+    pointers = []
+    tags = []
+    values = []
+    current = -1
+    for line in lines:
+        l, p, t, v = _split_line(number, line)
+        if l > current + 1:
+            _error(number, "Structure of GEDCOM file is corrupted")
+        current = l
+        levels.append(l)
+        pointers.append(p)
+        tags.append(intern(t))
+        values.append(v)
+        number += 1
+    return levels, pointers, tags, values
+
+
+def _split_line(number, line):
+    """Returns the Level, Pointer, Tag and Value of a line.
+
+    The line is split at most three times, as level [pointer] tag
+    rest, so the value is kept exactly as it appears in the file.
+    A pointer value must be the only thing after the tag.
+
+    """
+    parts = line.rstrip('\r\n').split(None, 1)
+    if not parts:
+        _error(number, "Empty line")
+    try:
+        l = int(parts[0])
+    except ValueError:
+        _error(number, "Line must start with an integer level")
+    if l < 0:
+        _error(number, "Line must start with a positive integer")
+    if len(parts) < 2:
+        _error(number, "Incomplete Line")
+    rest = parts[1]
+    p = ''
+    if rest[0] == '@':
+        parts = rest.split(None, 1)
+        p = parts[0]
+        if p[-1] != '@':
+            _error(number, "Pointer element must start and end with @")
+        if len(parts) < 2:
+            _error(number, "Incomplete line")
+        rest = parts[1]
+    parts = rest.split(None, 1)
+    t = parts[0]
+    v = parts[1] if len(parts) > 1 else ''
+    if v[:1] == '@' and v[:2] != '@#':
+        # a pointer value is looked up as a key, so it must stand alone
+        parts = v.split()
+        if parts[0][-1] == '@':
+            if len(parts) > 1:
+                _error(number, "Too many elements")
+            v = parts[0]
+    return l, p, t, v
+
+
+def _error(number, text):
+    """Raises gedcom file format error"""
+
+    error = "Gedcom format error on line " + str(number) + ': ' + text
+    raise GedcomParseError, error
+
+
+def _tokenize_chunk(chunk):
+    """Tokenize one chunk of a file in a worker process, the chunk being
+    a (file, start, end, number, encoding) tuple of byte offsets, the
+    number of the first line and the encoding of the file."""
+    (file, start, end, number, encoding) = chunk
+    with open(file, 'rb') as f:
+        f.seek(start)
+        data = gedcomreader.decode(f.read(end - start), encoding)
+    return _tokenize(data, number)
+
+
+class LazyGedcom(object):
+    """Gedcom parser that only parses the records it is asked for.
+
+    The file is memory mapped and scanned once for the byte offset, tag
+    and pointer of each level-0 record.  A record is parsed when it is
+    looked up in element_dict() or reached by iterating over records,
+    and the parsed records are kept in a least recently used cache of
+    a fixed size, so memory use has a ceiling however large the file.
+    A record dropped from the cache is parsed again when it is next
+    needed, as a new set of elements.  Only level-0 pointers are
+    indexed.
+
+    """
+
+    def __init__(self, file, records=1000):
+        """Initialize a lazy Gedcom parser for a Gedcom file, keeping at
+        most the given number of parsed records."""
+        self.__size = records
+        self.__cache = collections.OrderedDict()
+        self.__dict = LazyDict(self)
+        self.__map = None
+        with open(file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__scan()
+
+    def element_dict(self):
+        """Return a dictionary-like view of the records identified by a
+        pointer, which parses each record as it is looked up."""
+        return self.__dict
+
+    def element_list(self):
+        """Iterate over all of the elements in the Gedcom file, in the
+        order they appeared in the file, one record at a time."""
+        for i in xrange(len(self.__tags)):
+            stack = [self.record(i)]
+            while stack:
+                e = stack.pop()
+                yield e
+                stack.extend(reversed(e.children()))
+
+    def records(self, tag=None):
+        """Iterate over the level-0 records with the given tag, or over
+        all of them, in the order they appeared in the Gedcom file."""
+        for i in xrange(len(self.__tags)):
+            if tag is None or self.__tags[i] == tag:
+                yield self.record(i)
+
+    def individuals(self):
+        """Iterate over the individual (INDI) records."""
+        return self.records("INDI")
+
+    def families(self):
+        """Iterate over the family (FAM) records."""
+        return self.records("FAM")
+
+    def sources(self):
+        """Iterate over the source (SOUR) records."""
+        return self.records("SOUR")
+
+    def pointers(self):
+        """Return a dictionary of each record pointer and its position
+        in the file."""
+        return self.__index
+
+    def record(self, position):
+        """Return the record at a position in the file, parsing it if it
+        is not in the cache."""
+        e = self.__cache.pop(position, None)
+        if e is None:
+            e = self.__parse_record(position)
+            if len(self.__cache) >= self.__size:
+                self.__cache.popitem(last=False)
+        self.__cache[position] = e
+        return e
+
+    def close(self):
+        """Release the memory map of the file."""
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    # Private methods
+
+    def __scan(self):
+        """Record the offset, first line number, tag and pointer of every
+        level-0 record."""
+        self.__starts = []
+        self.__numbers = []
+        self.__tags = []
+        self.__index = {}
+        data = self.__map
+        if data is None:
+            self.__starts.append(0)
+            return
+        size = len(data)
+        (encoding, start) = gedcomreader.detect(data[:gedcomreader.BLOCK])
+        unit = gedcomreader.width(encoding)
+        newline = gedcomreader.encode('\n', encoding)
+        self.__encoding = encoding
+        number = 1
+        while start < size:
+            end = gedcomreader.findrecord(data, encoding, start)
+            end = size if end < 0 else end + unit
+            record = data[start:end]
+            stop = gedcomreader.find(record, '\n', encoding)
+            line = record if stop < 0 else record[:stop]
+            parts = gedcomreader.decode(line, encoding).split(None, 3)
+            tag = ''
+            if len(parts) > 2 and parts[1][:1] == '@':
+                self.__index[parts[1]] = len(self.__tags)
+                tag = parts[2]
+            elif len(parts) > 1:
+                tag = parts[1]
+            self.__starts.append(start)
+            self.__numbers.append(number)
+            self.__tags.append(intern(tag))
+            number += record.count(newline)
+            start = end
+        self.__starts.append(size)
+
+    def __parse_record(self, position):
+        """Parse the record at a position in the file."""
+        data = self.__map[self.__starts[position]:self.__starts[position + 1]]
+        data = gedcomreader.decode(data, self.__encoding)
+        rows = _tokenize(data, self.__numbers[position])
+        (levels, pointers, tags, values) = rows
+        stack = [Element(-1, "", "TOP", "", self.__dict)]
+        for i in xrange(len(levels)):
+            if i > 0 and levels[i] == 0:
+                _error(self.__numbers[position] + i, "Level-0 line found inside a record")
+            e = Element(levels[i],pointers[i],tags[i],values[i],self.__dict)
+            del stack[levels[i] + 1:]
+            stack[-1].add_child(e, True)
+            e.add_parent(stack[-1])
+            stack.append(e)
+        return stack[0].children()[0]
+
+
+class LazyDict(object):
+    """Dictionary of the records of a LazyGedcom by pointer, parsing each
+    record as it is looked up."""
+
+    def __init__(self, gedcom):
+        """Initialize the dictionary for a LazyGedcom."""
+        self.__gedcom = gedcom
+
+    def get(self, pointer, default=None):
+        """Return the record with a pointer, or default if there is none."""
+        position = self.__gedcom.pointers().get(pointer)
+        if position is None:
+            return default
+        return self.__gedcom.record(position)
+
+    def __getitem__(self, pointer):
+        """Return the record with a pointer."""
+        return self.__gedcom.record(self.__gedcom.pointers()[pointer])
+
+    def __contains__(self, pointer):
+        """Check if a record has a pointer, without parsing it."""
+        return pointer in self.__gedcom.pointers()
+
+    def has_key(self, pointer):
+        """Check if a record has a pointer, without parsing it."""
+        return pointer in self
+
+    def keys(self):
+        """Return the pointers of the records."""
+        return self.__gedcom.pointers().keys()
+
+    def __iter__(self):
+        """Iterate over the pointers of the records."""
+        return iter(self.__gedcom.pointers())
+
+    def __len__(self):
+        """Return the number of records with a pointer."""
+        return len(self.__gedcom.pointers())
+
+
+class FamilyIndex(object):
+    """Family membership of a Gedcom file by pointer, in both directions:
+    the families in which each individual is a spouse (FAMS) or a child
+    (FAMC), and the husbands (HUSB), wives (WIFE) and children (CHIL) of
+    each family.
+
+    It is built in one pass over the individual and family records, and
+    a link given on only one side is added to the other, as far as the
+    tags allow: a FAMS pointer doesn't say whether the individual is the
+    husband or the wife.
+
+    """
+
+    def __init__(self, individuals, families):
+        self.__spouse = {}
+        self.__child = {}
+        self.__husbands = {}
+        self.__wives = {}
+        self.__children = {}
+        links = {"FAMS": self.__spouse, "FAMC": self.__child}
+        for indi in individuals:
+            for e in indi.children():
+                index = links.get(e.tag())
+                if index is not None:
+                    self.__add(index, indi.pointer(), e.value())
+                    if e.tag() == "FAMC":
+                        self.__add(self.__children, e.value(), indi.pointer())
+        members = {"HUSB": self.__husbands, "WIFE": self.__wives, "CHIL": self.__children}
+        for fam in families:
+            for e in fam.children():
+                index = members.get(e.tag())
+                if index is not None:
+                    self.__add(index, fam.pointer(), e.value())
+                    if e.tag() == "CHIL":
+                        self.__add(self.__child, e.value(), fam.pointer())
+                    else:
+                        self.__add(self.__spouse, e.value(), fam.pointer())
+
+    def __add(self, index, key, pointer):
+        """Add a pointer to the list of a key, once."""
+        pointers = index.get(key)
+        if pointers is None:
+            index[key] = [pointer]
+        elif pointer not in pointers:
+            pointers.append(pointer)
+
+    def spouse_families(self, pointer):
+        """Return the pointers of the families in which an individual is a spouse."""
+        return self.__spouse.get(pointer, ())
+
+    def child_families(self, pointer):
+        """Return the pointers of the families in which an individual is a child."""
+        return self.__child.get(pointer, ())
+
+    def husbands(self, pointer):
+        """Return the pointers of the husbands of a family."""
+        return self.__husbands.get(pointer, ())
+
+    def wives(self, pointer):
+        """Return the pointers of the wives of a family."""
+        return self.__wives.get(pointer, ())
+
+    def children(self, pointer):
+        """Return the pointers of the children of a family."""
+        return self.__children.get(pointer, ())
+
+    def families(self):
+        """Return the pointers of all of the families with members."""
+        return set(self.__husbands) | set(self.__wives) | set(self.__children)
+
+
 class GedcomParseError(Exception):
     """Exception raised when a Gedcom parsing error occurs."""
 
     def __init__(self, value):
+        # pass the value on so the error can be pickled back from a worker
+        Exception.__init__(self, value)
         self.value = value
 
     def __str__(self):
         return `self.value`
 
-class Element:
+class Summary(object):
+    """Facts about an individual or family record, worked out in a single
+    pass over its children and cached by Element.summary().
+
+    Dates and places are None when the record has no such event, or
+    when the event has no DATE or PLAC, and years are -1 when unknown.
+
+    """
+
+    __slots__ = ('name', 'birth', 'birth_year', 'death', 'death_year',
+                 'residence', 'residence_year', 'deceased', 'fams',
+                 'marriage', 'marriage_years')
+
+
+class Event(object):
+    """An event of an individual or family record, as returned by
+    Element.events(): its tag, the values of its DATE and PLAC, the year
+    of the date and the values of its SOUR children.
+
+    Dates and places are '' when the event has none, and the year is 0
+    when the date has no four-digit year.
+
+    """
+
+    __slots__ = ('tag', 'date', 'year', 'place', 'sources')
+
+    def __init__(self, tag, date, year, place, sources):
+        self.tag = tag
+        self.date = date
+        self.year = year
+        self.place = place
+        self.sources = sources
+
+
+YEAR_PATTERN = re.compile(r'\d{4}')
+
+
+class Query(object):
+    """Criteria string compiled once, as returned by Gedcom.compile_query.
+
+    The query is a predicate: query(element) is the same as
+    element.criteria_match(criteria), without parsing the criteria
+    again for every element.
+
+    """
+
+    def __init__(self, criteria):
+        """Parse and check a colon-separated criteria string."""
+        self.criteria = criteria
+        # (surname, value) pairs, surname being False for given names
+        self.names = []
+        # (event, year1, year2) ranges of birth, death and marriage years
+        self.years = []
+        self.valid = True
+        items = [crit.split('=') for crit in criteria.split(':')]
+        if [item for item in items if len(item) != 2]:
+            self.valid = False
+            return
+        for key, value in items:
+            if key == "surname" or key == "name":
+                self.names.append((key == "surname", value))
+            elif key in ("birth", "death", "marriage"):
+                try:
+                    year = int(value)
+                except ValueError:
+                    self.valid = False
+                else:
+                    self.years.append((key, year, year))
+            elif key in ("birthrange", "deathrange", "marriagerange"):
+                try:
+                    year1, year2 = value.split('-')
+                    self.years.append((key[:-5], int(year1), int(year2)))
+                except ValueError:
+                    self.valid = False
+
+    def __call__(self, element):
+        """Check if an element matches the query."""
+        return self.match(element)
+
+    def match(self, element):
+        """Check if an element matches all of the criteria."""
+        if not self.valid:
+            return False
+        for key, year1, year2 in self.years:
+            if key == "birth":
+                if not element.birth_range_match(year1, year2):
+                    return False
+            elif key == "death":
+                if not element.death_range_match(year1, year2):
+                    return False
+            elif not element.marriage_range_match(year1, year2):
+                return False
+        return self.names_match(element)
+
+    def names_match(self, element):
+        """Check if an element matches the name criteria only."""
+        for surname, value in self.names:
+            if surname:
+                if not element.surname_match(value):
+                    return False
+            elif not element.given_match(value):
+                return False
+        return True
+
+
+def year_of(date):
+    """Return the year of a Gedcom date (its last word) as an integer,
+    or -1 if there is none."""
+    words = date.split()
+    if not words:
+        return -1
+    try:
+        return int(words[-1])
+    except ValueError:
+        return -1
+
+
+class Element(object):
     """Gedcom element
 
     Each line in a Gedcom file is an element with the format
@@ -242,8 +922,17 @@ class Element:
 
     See a Gedcom file for examples of tags and their values.
 
+    Elements use __slots__ and share one empty tuple for the children
+    of leaf elements, since a file produces one element per line and
+    the per-instance dictionary would otherwise outweigh the data.
+    The index of children by tag is only built for elements that are
+    asked for it with children_by_tag().
+
     """
 
+    __slots__ = ('__level', '__pointer', '__tag', '__value', '__dict',
+                 '__children', '__parent', '__tagged', '__summary')
+
     def __init__(self,level,pointer,tag,value,dict):
         """Initialize an element.  You must include a level, pointer,
         tag, value, and global element dictionary.  Normally
@@ -257,8 +946,10 @@ class Element:
         self.__value = value
         self.__dict = dict
         # structuring
-        self.__children = []
+        self.__children = ()
         self.__parent = None
+        self.__tagged = None
+        self.__summary = None
 
     def level(self):
         """Return the level of this element."""
@@ -277,16 +968,130 @@ class Element:
         return self.__value
 
     def children(self):
-        """Return the child elements of this element."""
-        return self.__children
+        """Return the list of child elements of this element."""
+        # leaves share one empty tuple, so give them a list of their own
+        return self.__children or []
+
+    def children_by_tag(self, tag):
+        """Return the child elements of this element with the given tag,
+        in the order they appeared in the Gedcom file.
+
+        """
+        if self.__tagged is None:
+            self.__tagged = {}
+            for e in self.__children:
+                self.__tagged.setdefault(e.tag(), []).append(e)
+        return self.__tagged.get(tag, ())
 
     def parent(self):
         """Return the parent element of this element."""
         return self.__parent
 
-    def add_child(self, element):
-        """Add a child element to this element."""
-        self.children().append(element)
+    def add_child(self, element, parsing=False):
+        """Add a child element to this element.  The parser passes True
+        for parsing, as nothing can have been summarised yet in a tree
+        it is still building.
+
+        """
+        if self.__children:
+            self.__children.append(element)
+        else:
+            self.__children = [element]
+        if self.__tagged is not None:
+            self.__tagged.setdefault(element.tag(), []).append(element)
+        if parsing:
+            return
+        # the summaries of this element and its ancestors are out of date
+        e = self
+        while e is not None:
+            e.__summary = None
+            e = e.__parent
+
+    def summary(self):
+        """Return the Summary of this element, working it out on first use.
+        It is forgotten whenever an element is added below this one.
+
+        """
+        if self.__summary is None:
+            self.__summary = self.__summarise()
+        return self.__summary
+
+    def __summarise(self):
+        """Work out the Summary of this element in one pass over its children."""
+        first = ""
+        last = ""
+        events = {}
+        marriage_years = []
+        fams = []
+        for e in self.children():
+            tag = e.tag()
+            if tag == "NAME":
+                # some older Gedcom files don't use child tags but instead
+                # place the name in the value of the NAME tag
+                if e.value() != "":
+                    name = string.split(e.value(),'/')
+                    first = string.strip(name[0])
+                    if e.value().find('/') <> -1:
+                        last = string.strip(name[1])
+                    else:
+                        last = 'Unknown'
+                else:
+                    for c in e.children():
+                        if c.tag() == "GIVN":
+                            first = c.value()
+                        if c.tag() == "SURN":
+                            last = c.value()
+            elif tag == "BIRT" or tag == "DEAT" or tag == "RESI" or tag == "MARR":
+                (date, place) = events.get(tag, (None, None))
+                for c in e.children():
+                    if c.tag() == "DATE":
+                        date = c.value()
+                        if tag == "MARR":
+                            year = year_of(date)
+                            if year != -1:
+                                marriage_years.append(year)
+                    if c.tag() == "PLAC":
+                        place = c.value()
+                events[tag] = (date, place)
+            elif tag == "FAMS":
+                fams.append(e.value())
+        summary = Summary()
+        summary.name = (first, last)
+        summary.birth = events.get("BIRT", (None, None))
+        summary.death = events.get("DEAT", (None, None))
+        summary.residence = events.get("RESI", (None, None))
+        summary.marriage = events.get("MARR", (None, None))
+        summary.birth_year = year_of(summary.birth[0] or "")
+        summary.death_year = year_of(summary.death[0] or "")
+        summary.residence_year = year_of(summary.residence[0] or "")
+        summary.marriage_years = marriage_years
+        summary.deceased = "DEAT" in events
+        summary.fams = fams
+        return summary
+
+    def events(self):
+        """Return an Event for each child of this element with a DATE,
+        PLAC or SOUR, in the order they appeared in the Gedcom file.
+
+        """
+        events = []
+        for e in self.__children:
+            date = ''
+            place = ''
+            sources = []
+            for c in e.__children:
+                tag = c.__tag
+                if tag == "DATE":
+                    date = c.__value
+                elif tag == "PLAC":
+                    place = c.__value
+                elif tag == "SOUR":
+                    sources.append(c.__value)
+            if date or place or sources:
+                match = YEAR_PATTERN.search(date)
+                year = int(match.group()) if match else 0
+                events.append(Event(e.__tag, date, year, place, tuple(sources)))
+        return events
 
     def add_parent(self, element):
         """Add a parent element to this element."""
@@ -334,69 +1139,7 @@ class Element:
         marriagerange=[year1-year2]
 
         """
-        # error checking on the criteria
-        try:
-            for crit in criteria.split(':'):
-                key, value = crit.split('=')
-        except ValueError:
-            return False
-        match = True
-        for crit in criteria.split(':'):
-            key, value = crit.split('=')
-            if key == "surname" and not self.surname_match(value):
-                match = False
-            elif key == "name" and not self.given_match(value):
-                match = False
-            elif key == "birth":
-                try:
-                    year = int(value)
-                    if not self.birth_year_match(year):
-                        match = False
-                except ValueError:
-                    match = False
-            elif key == "birthrange":
-                try:
-                    year1, year2 = value.split('-')
-                    year1 = int(year1)
-                    year2 = int(year2)
-                    if not self.birth_range_match(year1, year2):
-                        match = False
-                except ValueError:
-                    match = False
-            elif key == "death":
-                try:
-                    year = int(value)
-                    if not self.death_year_match(year):
-                        match = False
-                except ValueError:
-                    match = False
-            elif key == "deathrange":
-                try:
-                    year1, year2 = value.split('-')
-                    year1 = int(year1)
-                    year2 = int(year2)
-                    if not self.death_range_match(year1, year2):
-                        match = False
-                except ValueError:
-                    match = False
-            elif key == "marriage":
-                try:
-                    year = int(value)
-                    if not self.marriage_year_match(year):
-                        match = False
-                except ValueError:
-                    match = False
-            elif key == "marriagerange":
-                try:
-                    year1, year2 = value.split('-')
-                    year1 = int(year1)
-                    year2 = int(year2)
-                    if not self.marriage_range_match(year1, year2):
-                        match = False
-                except ValueError:
-                    match = False
-
-        return match
+        return Query(criteria).match(self)
 
     def surname_match(self, name):
         """Match a string with the surname of an individual."""
@@ -458,37 +1201,17 @@ class Element:
     def families(self):
         """Return a list of all of the family elements of a person."""
         results = []
-        for e in self.children():
-            if e.tag() == "FAMS":
-                f = self.__dict.get(e.value(),None)
-                if f != None:
-                    results.append(f)
+        for pointer in self.summary().fams:
+            f = self.__dict.get(pointer,None)
+            if f != None:
+                results.append(f)
         return results
 
     def name(self):
         """Return a person's names as a tuple: (first,last)."""
-        first = ""
-        last = ""
         if not self.individual():
-            return (first, last)
-        for e in self.children():
-            if e.tag() == "NAME":
-                # some older Gedcom files don't use child tags but instead
-                # place the name in the value of the NAME tag
-                if e.value() != "":
-                    name = string.split(e.value(),'/')
-                    first = string.strip(name[0])
-                    if e.value().find('/') <> -1:
-                        last = string.strip(name[1])
-                    else:
-                        last = 'Unknown'
-                else:
-                    for c in e.children():
-                        if c.tag() == "GIVN":
-                            first = c.value()
-                        if c.tag() == "SURN":
-                            last = c.value()
-        return (first, last)
+            return ("", "")
+        return self.summary().name
 
     def indi(self):
         """Return the individual ("P" value) of a person."""
@@ -501,111 +1224,48 @@ class Element:
 
     def birth(self):
         """Return the birth tuple of a person as (date, place)."""
-        date = ""
-        place = ""
         if not self.individual():
-            return (date, place)
-        for e in self.children():
-            if e.tag() == "BIRT":
-                for c in e.children():
-                    if c.tag() == "DATE":
-                        date = c.value()
-                    if c.tag() == "PLAC":
-                        place = c.value()
-        return (date, place)
+            return ("", "")
+        (date, place) = self.summary().birth
+        return (date or "", place or "")
 
     def birth_year(self):
         """Return the birth year of a person in integer format."""
-        date = ""
         if not self.individual():
-            return date
-        for e in self.children():
-            if e.tag() == "BIRT":
-                for c in e.children():
-                    if c.tag() == "DATE":
-                        datel = string.split(c.value())
-                        date = datel[len(datel)-1]
-        if date == "":
-            return -1
-        try:
-            return int(date)
-        except ValueError:
-            return -1
+            return ""
+        return self.summary().birth_year
 
     def residence(self):
         """Return the residence tuple of a person as (date, place)."""
-        date = ""
-        place = ""
         if not self.individual():
-            return (date, place)
-        for elem in self.children():
-            if elem.tag() == "RESI":
-                for child in elem.children():
-                    if child.tag() == "DATE":
-                        date = child.value()
-                    if child.tag() == "PLAC":
-                        place = child.value()
-        return (date, place)
+            return ("", "")
+        (date, place) = self.summary().residence
+        return (date or "", place or "")
 
     def residence_year(self):
         """Return the birth year of a person in integer format."""
-        date = ""
         if not self.individual():
-            return date
-        for elem in self.children():
-            if elem.tag() == "RESI":
-                for child in elem.children():
-                    if child.tag() == "DATE":
-                        datel = string.split(child.value())
-                        date = datel[len(datel)-1]
-        if date == "":
-            return -1
-        try:
-            return int(date)
-        except ValueError:
-            return -1
+            return ""
+        return self.summary().residence_year
 
     def death(self):
         """Return the death tuple of a person as (date, place)."""
-        date = ""
-        place = ""
         if not self.individual():
-            return (date, place)
-        for e in self.children():
-            if e.tag() == "DEAT":
-                for c in e.children():
-                    if c.tag() == "DATE":
-                        date = c.value()
-                    if c.tag() == "PLAC":
-                        place = c.value()
-        return (date, place)
+            return ("", "")
+        (date, place) = self.summary().death
+        return (date or "", place or "")
 
     def death_year(self):
         """Return the death year of a person in integer format."""
-        date = ""
         if not self.individual():
-            return date
-        for e in self.children():
-            if e.tag() == "DEAT":
-                for c in e.children():
-                    if c.tag() == "DATE":
-                        datel = string.split(c.value())
-                        date = datel[len(datel)-1]
-        if date == "":
-            return -1
-        try:
-            return int(date)
-        except ValueError:
-            return -1
+            return ""
+        return self.summary().death_year
 
     def deceased(self):
         """Check if a person is deceased."""
         if not self.individual():
             return False
-        for e in self.children():
-            if e.tag() == "DEAT":
-                return True
-        return False
+        return self.summary().deceased
 
     def marriage(self):
         """Return a list of marriage tuples for a person, each listing
@@ -616,18 +1276,15 @@ class Element:
         place = ""
         if not self.individual():
             return (date, place)
-        for e in self.children():
-            if e.tag() == "FAMS":
-                f = self._Element__dict.get(e.value(), None)
-                if f == None:
-                    return (date, place)
-                for g in f.children():
-                    if g.tag() == "MARR":
-                        for h in g.children():
-                            if h.tag() == "DATE":
-                                date = h.value()
-                            if h.tag() == "PLAC":
-                                place = h.value()
+        for pointer in self.summary().fams:
+            f = self.__dict.get(pointer, None)
+            if f == None:
+                return (date, place)
+            (fdate, fplace) = f.summary().marriage
+            if fdate is not None:
+                date = fdate
+            if fplace is not None:
+                place = fplace
         return (date, place)
 
     def marriage_years(self):
@@ -638,21 +1295,11 @@ class Element:
         dates = []
         if not self.individual():
             return dates
-        for e in self.children():
-            if e.tag() == "FAMS":
-                f = self.__dict.get(e.value(),None)
-                if f == None:
-                    return dates
-                for g in f.children():
-                    if g.tag() == "MARR":
-                        for h in g.children():
-                            if h.tag() == "DATE":
-                                datel = string.split(h.value())
-                                date = datel[len(datel)-1]
-                                try:
-                                    dates.append(int(date))
-                                except ValueError:
-                                    pass
+        for pointer in self.summary().fams:
+            f = self.__dict.get(pointer,None)
+            if f == None:
+                return dates
+            dates.extend(f.summary().marriage_years)
         return dates
 
     def get_individual(self):
@@ -0,0 +1,172 @@
+"""
+-------------------------------------------------------------------------------
+ Name:      gedcomreader.py
+ Purpose:   Module to read GEDCOM files in any of their character sets and
+            hand the text to the parser as UTF-8.
+
+            The character set is taken from the byte order mark or, failing
+            that, from the CHAR line of the HEAD record.  Text is decoded a
+            buffer at a time: ANSEL through a precomputed charmap table and
+            the other character sets through the standard codecs.
+
+ Author:    agent
+
+ Created:   18/10/2026
+ Copyright: (c) agent 2026
+ Licence:   This work is licensed under the Creative Commons Attribution-NonCommercial 4.0
+            International License. To view a copy of this license,
+            visit http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
+            Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+ The GEDCOM Standard Release 5.5: http://homepages.rootsweb.ancestry.com/~pmcbride/gedcom/55gcch2.htm#S1
+------------------------------------------------------------------------------
+"""
+#Standard Modules
+import codecs
+import re
+import unicodedata
+
+# Size of the buffers read from the file.
+BLOCK = 1 << 20
+
+# Byte order marks, longest first, and the codecs they select.
+BOMS = ((codecs.BOM_UTF8, 'utf-8'),
+        (codecs.BOM_UTF16_LE, 'utf-16-le'),
+        (codecs.BOM_UTF16_BE, 'utf-16-be'))
+
+# Values of the HEAD CHAR tag and the codecs used to read them.
+CHARSETS = {'UTF-8': 'utf-8',
+            'UTF8': 'utf-8',
+            'UNICODE': 'utf-16-le',
+            'ANSEL': 'ansel',
+            'ANSI': 'cp1252',
+            'ASCII': 'cp1252',
+            'IBMPC': 'cp437',
+            'MACINTOSH': 'mac_roman'}
+
+CHAR_PATTERN = re.compile(r'^\s*1\s+CHAR\s+(\S+)', re.MULTILINE)
+
+# ANSEL (ANSI Z39.47) characters above 0x7F, with the GEDCOM additions.
+# The combining diacritics come before the letter they belong to.
+ANSEL_CHARACTERS = {
+    0xA1: u'\u0141', 0xA2: u'\u00d8', 0xA3: u'\u0110', 0xA4: u'\u00de',
+    0xA5: u'\u00c6', 0xA6: u'\u0152', 0xA7: u'\u02b9', 0xA8: u'\u00b7',
+    0xA9: u'\u266d', 0xAA: u'\u00ae', 0xAB: u'\u00b1', 0xAC: u'\u01a0',
+    0xAD: u'\u01af', 0xAE: u'\u02bc', 0xB0: u'\u02bb', 0xB1: u'\u0142',
+    0xB2: u'\u00f8', 0xB3: u'\u0111', 0xB4: u'\u00fe', 0xB5: u'\u00e6',
+    0xB6: u'\u0153', 0xB7: u'\u02ba', 0xB8: u'\u0131', 0xB9: u'\u00a3',
+    0xBA: u'\u00f0', 0xBC: u'\u01a1', 0xBD: u'\u01b0', 0xBE: u'\u25a1',
+    0xBF: u'\u25a0', 0xC0: u'\u00b0', 0xC1: u'\u2113', 0xC2: u'\u2117',
+    0xC3: u'\u00a9', 0xC4: u'\u266f', 0xC5: u'\u00bf', 0xC6: u'\u00a1',
+    0xC7: u'\u00df', 0xC8: u'\u20ac', 0xCF: u'\u00df',
+    0xE0: u'\u0309', 0xE1: u'\u0300', 0xE2: u'\u0301', 0xE3: u'\u0302',
+    0xE4: u'\u0303', 0xE5: u'\u0304', 0xE6: u'\u0306', 0xE7: u'\u0307',
+    0xE8: u'\u0308', 0xE9: u'\u030c', 0xEA: u'\u030a', 0xEB: u'\ufe20',
+    0xEC: u'\ufe21', 0xED: u'\u0315', 0xEE: u'\u030b', 0xEF: u'\u0310',
+    0xF0: u'\u0327', 0xF1: u'\u0328', 0xF2: u'\u0323', 0xF3: u'\u0324',
+    0xF4: u'\u0325', 0xF5: u'\u0333', 0xF6: u'\u0332', 0xF7: u'\u0326',
+    0xF8: u'\u031c', 0xF9: u'\u032e', 0xFA: u'\ufe22', 0xFB: u'\ufe23',
+    0xFE: u'\u0313'}
+
+ANSEL_TABLE = u''.join(unichr(code) if code < 0x80 else ANSEL_CHARACTERS.get(code, u'\ufffd')
+                       for code in xrange(256))
+
+# Combining marks in front of a letter, to be moved after it.
+ANSEL_MARKS = re.compile(u'([\u0300-\u036f\ufe20-\ufe23]+)([^\u0300-\u036f\ufe20-\ufe23])',
+                         re.UNICODE)
+
+
+def detect(head):
+    """Return the codec of a Gedcom file and the length of its byte order
+    mark, given the first block of the file."""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    if head[:2] == '0\x00':
+        return 'utf-16-le', 0
+    if head[:2] == '\x000':
+        return 'utf-16-be', 0
+    match = CHAR_PATTERN.search(head)
+    if match:
+        return CHARSETS.get(match.group(1).upper(), 'utf-8'), 0
+    return 'utf-8', 0
+
+
+def width(encoding):
+    """Return the number of bytes in each unit of an encoding."""
+    if encoding.startswith('utf-16'):
+        return 2
+    return 1
+
+
+def encode(text, encoding):
+    """Return some ASCII text as it is written in a file of an encoding,
+    for searching the raw bytes."""
+    if width(encoding) == 2:
+        return text.encode(encoding)
+    return text
+
+
+def find(data, text, encoding, start=0):
+    """Return the offset of some ASCII text in the raw bytes of a file of
+    an encoding, at or after start, or -1.  Start must be on a unit
+    boundary."""
+    sub = encode(text, encoding)
+    unit = width(encoding)
+    pos = data.find(sub, start)
+    while pos >= 0 and (pos - start) % unit:
+        pos = data.find(sub, pos + 1)
+    return pos
+
+
+def findrecord(data, encoding, start=0):
+    """Return the offset of the newline before the next level-0 line in
+    the raw bytes of a file of an encoding, at or after start, or -1.
+    The level may be followed by a space or a tab."""
+    unit = width(encoding)
+    blanks = (encode(' ', encoding), encode('\t', encoding))
+    pos = find(data, '\n0', encoding, start)
+    while pos >= 0 and data[pos + 2 * unit:pos + 3 * unit] not in blanks:
+        pos = find(data, '\n0', encoding, pos + unit)
+    return pos
+
+
+def decode(data, encoding):
+    """Return a block of a file of an encoding as UTF-8 text.  The block
+    must not end part way through a line."""
+    if encoding == 'utf-8':
+        return data
+    if encoding == 'ansel':
+        text = codecs.charmap_decode(data, 'strict', ANSEL_TABLE)[0]
+        if ANSEL_MARKS.search(text):
+            text = unicodedata.normalize('NFC', ANSEL_MARKS.sub(u'\\2\\1', text))
+        return text.encode('utf-8')
+    return data.decode(encoding, 'replace').encode('utf-8')
+
+
+def readlines(file):
+    """Yield the lines of a Gedcom file as UTF-8 text, without the byte
+    order mark or newlines."""
+    with open(file, 'rb') as f:
+        block = f.read(BLOCK)
+        (encoding, start) = detect(block)
+        block = block[start:]
+        if width(encoding) == 2:
+            # decoded as it is read, since a block may split a character
+            decoder = codecs.getincrementaldecoder(encoding)('replace')
+            encoding = 'utf-8'
+        else:
+            decoder = None
+        pending = ''
+        while block:
+            if decoder is not None:
+                block = decoder.decode(block).encode('utf-8')
+            data = pending + block
+            cut = data.rfind('\n') + 1
+            pending = data[cut:]
+            lines = decode(data[:cut], encoding).split('\n')
+            lines.pop()
+            for line in lines:
+                yield line
+            block = f.read(BLOCK)
+        if pending:
+            yield decode(pending, encoding)
@@ -13,14 +13,183 @@
             Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
 ------------------------------------------------------------------------------
 """
+#Standard Modules
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from geopy.exc import GeocoderQuotaExceeded, GeocoderServiceError
+except ImportError:
+    class GeocoderServiceError(Exception):
+        """Stand-in for geopy.exc.GeocoderServiceError."""
+        pass
+
+    class GeocoderQuotaExceeded(GeocoderServiceError):
+        """Stand-in for geopy.exc.GeocoderQuotaExceeded."""
+        pass
+
+#Seconds allowed for each request to a locator.
+TIMEOUT = 10
+
+#Seconds to wait before the first retry of a request refused by the rate limit.
+BACKOFF = 1.0
+
+#Consecutive failed requests that stop requests to a locator, and the
+#seconds before it is tried again.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60.0
+
+#Requests per second allowed by each locator.
+RATES = {'ArcGIS': 5.0,
+         'Google': 50.0,
+         'Bing': 5.0,
+         'GeoNames': 0.5,
+         'OSM': 1.0,
+         'OpenCage': 1.0,
+         'OpenMapQuest': 1.0}
+
+#Abbreviations expanded when place names are normalised, by default.
+ABBREVIATIONS = {'nsw': 'new south wales',
+                 'vic': 'victoria',
+                 'qld': 'queensland',
+                 'tas': 'tasmania',
+                 'nt': 'northern territory',
+                 'act': 'australian capital territory',
+                 'uk': 'united kingdom',
+                 'usa': 'united states'}
+
+class PlaceNormaliser(object):
+    """A class to reduce the different spellings of a place name to one key,
+    so that each place is only looked up and geocoded once."""
+
+    def __init__(self, abbreviations=None):
+        """Initialises the abbreviations to expand."""
+        self.abbreviations = dict(ABBREVIATIONS)
+        if abbreviations:
+            for abbr, expansion in abbreviations.iteritems():
+                self.abbreviations[abbr.lower()] = expansion.lower()
+        self.keys = {}
+
+    def readabbreviations(self, filename):
+        """Read extra abbreviations from a file of abbreviation=expansion lines."""
+        with open(filename) as fabbr:
+            for line in fabbr:
+                if '=' in line:
+                    abbr, expansion = line.split('=', 1)
+                    self.abbreviations[abbr.strip().lower()] = expansion.strip().lower()
+        self.keys = {}
+
+    def normalise(self, place):
+        """Return the key of a place: lower case, single spaced, with empty
+        comma-separated parts dropped and abbreviated parts expanded."""
+        key = self.keys.get(place)
+        if key is None:
+            parts = []
+            for part in place.lower().split(','):
+                part = ' '.join(part.split())
+                if part:
+                    parts.append(self.abbreviations.get(part, part))
+            key = ', '.join(parts)
+            self.keys[place] = key
+        return key
+
+    def normaliseall(self, places):
+        """Return a dictionary of the key of each place, and print how much
+        normalisation reduced the number of distinct places."""
+        keys = dict((place, self.normalise(place)) for place in places)
+        distinct = len(set(keys.itervalues()))
+        if keys:
+            print "Places: %d distinct, %d after normalisation (%.1f%% fewer)" % (
+                len(keys), distinct, 100.0 * (len(keys) - distinct) / len(keys))
+        return keys
+
+class TokenBucket(object):
+    """A token bucket limiting the rate of requests to a locator. It is
+    shared by all the threads geocoding for the locator."""
+
+    def __init__(self, rate, capacity=None):
+        """Initialises the bucket full, holding at least one token."""
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, deadline=None):
+        """Wait until a token is available and take it. Returns False,
+        without waiting, if no token would be available before the
+        deadline."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait >= deadline:
+                return False
+            time.sleep(wait)
+
+class CircuitBreaker(object):
+    """A circuit breaker that opens after a number of consecutive failed
+    requests, and lets one request through again after a cooldown."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        """Initialises the breaker closed."""
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request may be made."""
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.cooldown:
+                #Half open: let this request through, and reopen if it fails
+                self.opened = time.time()
+                return True
+            return False
+
+    def record(self, success):
+        """Record the outcome of a request."""
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold and self.opened is None:
+                    self.opened = time.time()
+                    self.trips += 1
+
 class GEOCODEPLAC(object):
     """A class to open the requested geolocator and handle the geocoding
     of place names."""
 
     qgeolocator = None
 
-    def __init__(self, locator):
-        """Initialises the Locator"""
+    def __init__(self, locator, rate=None, gazetteer='allCountries.txt', stub=None,
+                 budget=None, retries=3, secondary=None):
+        """Initialises the Locator and the limit on its request rate. The
+        Offline locator reads the named GeoNames gazetteer, and the Stub
+        locator is given the dictionary of stub settings. Requests stop after
+        budget seconds, or while the circuit breaker is open, and places are
+        then given to the secondary GEOCODEPLAC if there is one."""
+        if rate is None:
+            rate = RATES.get(locator)
+        self.bucket = TokenBucket(rate) if rate else None
+        self.deadline = None if budget is None else time.time() + budget
+        self.retries = retries
+        self.secondary = secondary
+        self.breaker = CircuitBreaker()
+        self.approximate = set()
         if locator == "ArcGIS":
             from geopy.geocoders import ArcGIS
             print "ArcGIS"
@@ -49,17 +218,172 @@ class GEOCODEPLAC(object):
             from geopy.geocoders import OpenMapQuest
             print "OpenMapQuest"
             self.qgeolocator = OpenMapQuest()
+        if locator == "Offline":
+            import gazetteer as offline
+            print "Offline"
+            self.qgeolocator = offline.Gazetteer(gazetteer)
+        if locator == "Stub":
+            import stublocator
+            print "Stub"
+            self.qgeolocator = stublocator.StubGeocoder(**(stub or {}))
 
     def geocode(self, place, flag):
-        """Call the Locator for geocoding."""
+        """Call the Locator for geocoding. Returns (0, 0) if the locator
+        can't find the place, or None if it couldn't be asked."""
         if flag == 'False':
             return(0,0)
-        else:
-            location = self.qgeolocator.geocode(place, timeout=10)
-            if location is None:
-                return(0, 0)
+        delay = BACKOFF
+        for attempt in xrange(self.retries + 1):
+            timeout = self.timeout()
+            if timeout <= 0 or not self.breaker.allow():
+                break
+            if self.bucket is not None and not self.bucket.take(self.deadline):
+                break
+            try:
+                location = self.qgeolocator.geocode(place, timeout=timeout)
+            except GeocoderQuotaExceeded:
+                #Refused by the rate limit: wait longer before each retry
+                if attempt < self.retries and self.timeout() > delay:
+                    time.sleep(delay)
+                    delay *= 2
+                    continue
+            except (GeocoderServiceError, IOError):
+                pass
             else:
-                return(location.latitude, location.longitude)
+                self.breaker.record(True)
+                if location is None:
+                    return(0, 0)
+                else:
+                    return(location.latitude, location.longitude)
+            self.breaker.record(False)
+            break
+        if self.secondary is not None:
+            return self.secondary.geocode(place, flag)
+        return None
+
+    def timeout(self):
+        """Return the seconds allowed for the next request within the budget."""
+        if self.deadline is None:
+            return TIMEOUT
+        return min(TIMEOUT, self.deadline - time.time())
+
+    def geocodeall(self, places, flag, threads=4):
+        """Geocode a list of places with a pool of threads, within the rate
+        limit of the locator. The positions are returned in the order of
+        the places."""
+        places = list(places)
+        if flag == 'False' or threads <= 1 or len(places) <= 1:
+            return [self.geocode(place, flag) for place in places]
+        pool = ThreadPool(min(threads, len(places)))
+        try:
+            return pool.map(lambda place: self.geocode(place, flag), places)
+        finally:
+            pool.close()
+            pool.join()
+
+    def geocode_many(self, places, flag, cache=None, threads=4, fallback=True):
+        """Return a dictionary of the (latitude, longitude) of each distinct
+        place. Places in the cache are read from it and the rest are
+        geocoded together. A place the locator can't find takes the position
+        of its parent place, found by dropping leading comma-separated parts
+        one at a time. Each level is looked up once and cached by itself, so
+        sibling places share their parent's result. Only each level's own
+        result is stored in the cache, unless geocoding was skipped, so a
+        place resolved from its parent is resolved again from the parent's
+        entry on every run, and is geocoded again once its own not-found
+        entry expires. Before any request, a place missing from the cache,
+        or cached as not found, takes the position of the most similar
+        cached place, if there is one. Parent places are not matched this
+        way, so that a place never strays into another region. The places
+        resolved from a similar or a parent place are kept in the
+        approximate set."""
+        self.approximate = set()
+        approximate = set()
+        positions = {}
+        resolved = {}
+        fallbacks = 0
+        cached = geocoded = failed = 0
+        #Places to look up, and the places of the file resolved by each
+        waiting = dict((place, [place]) for place in set(places))
+        first = True
+        while waiting:
+            missing = []
+            for place in waiting:
+                if place not in positions:
+                    coords = None if cache is None else cache.lookupplace(place)
+                    match = None
+                    if first and cache is not None and coords in (None, (0, 0)):
+                        match = cache.fuzzyplace(place)
+                    if match is not None:
+                        positions[place] = match[1]
+                        approximate.add(place)
+                    elif coords is None:
+                        missing.append(place)
+                    else:
+                        positions[place] = coords
+                        cached += 1
+            found = self.__request(missing, flag, threads)
+            positions.update(zip(missing, found))
+            answered = [(place, coords) for place, coords in zip(missing, found) if coords is not None]
+            geocoded += len(answered)
+            failed += len(missing) - len(answered)
+            if cache is not None and flag != 'False':
+                cache.addcodes(answered)
+            parents = {}
+            for place, dependants in waiting.iteritems():
+                coords = positions[place]
+                if coords is None:
+                    #Couldn't be asked: try the parent place for this run
+                    coords = (0, 0)
+                elif place in approximate:
+                    self.approximate.update(dependants)
+                parent = ''
+                if fallback and flag != 'False' and coords == (0, 0):
+                    parent = parentplace(place)
+                if parent:
+                    parents.setdefault(parent, []).extend(dependants)
+                else:
+                    for dependant in dependants:
+                        resolved[dependant] = coords
+                        if dependant != place and coords != (0, 0):
+                            self.approximate.add(dependant)
+                            fallbacks += 1
+            waiting = parents
+            first = False
+        print "Places: %d from the cache, %d approximate, %d geocoded, %d failed, %d from a parent place" % (
+            cached, len(approximate), geocoded, failed, fallbacks)
+        return resolved
+
+    def __request(self, places, flag, threads):
+        """Geocode a list of places in one request if the locator has a
+        geocode_batch method, or concurrently if not. The request is made
+        within the budget and while the circuit breaker is closed, and the
+        places are otherwise given to the secondary GEOCODEPLAC, or are
+        returned as None if there isn't one."""
+        batch = getattr(self.qgeolocator, 'geocode_batch', None)
+        if flag == 'False' or batch is None or not places:
+            return self.geocodeall(places, flag, threads)
+        timeout = self.timeout()
+        if timeout > 0 and self.breaker.allow() and \
+           (self.bucket is None or self.bucket.take(self.deadline)):
+            try:
+                locations = batch(places, timeout=timeout)
+            except (GeocoderServiceError, IOError):
+                #Ask for each place in turn, through the retries and fallbacks
+                self.breaker.record(False)
+                return self.geocodeall(places, flag, threads)
+            self.breaker.record(True)
+            return [(0, 0) if location is None else (location.latitude, location.longitude)
+                    for location in locations]
+        if self.secondary is not None:
+            return self.secondary.__request(places, flag, threads)
+        return [None] * len(places)
+
+def parentplace(place):
+    """Return the place containing a place, by dropping its first
+    comma-separated part, or '' if it has only one part."""
+    parts = [part.strip() for part in place.split(',')[1:]]
+    return ', '.join(part for part in parts if part)
 
 def main():
     """Main function."""
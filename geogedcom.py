@@ -19,10 +19,9 @@
 import argparse
 import arcpy
 import os
-import numpy
-import re
 #Project Modules
 import codesdict
+import eventtable
 import geocodeplace
 import gedcomparser
 import kmlgedcom
@@ -33,7 +32,7 @@ class MyFamily:
     def __init__(self):
         """ Initialize test class."""
         self.parse_options()
-        self.g = gedcomparser.Gedcom(self.filename)
+        self.g = gedcomparser.Gedcom(self.filename, cache=self.cachedir, workers=self.workers)
         self.info = 'names'
         self.indiplacelist = []
 
@@ -78,8 +77,57 @@ class MyFamily:
         parser.add_argument(
                             '-g', '--geocodeflag', required=False, help="If flag is false, actual geocoding is skipped.",
                             default = 'True', dest='geocodeflag')
+        parser.add_argument(
+                            '-x', '--cachedir', required=False, help="Directory in which to cache the parsed Gedcom file between runs.",
+                            default = None, dest='cachedir')
+        parser.add_argument(
+                            '-w', '--workers', required=False, type=int, help="Number of processes used to parse the Gedcom file.",
+                            default = 1, dest='workers')
+        parser.add_argument(
+                            '-d', '--placecache', required=False, help="SQLite file in which geocoded places are kept between runs.",
+                            default = None, dest='placecache')
+        parser.add_argument(
+                            '-b', '--abbreviations', required=False, help="File of abbreviation=expansion lines used to normalise place names.",
+                            default = None, dest='abbreviations')
+        parser.add_argument(
+                            '-t', '--threads', required=False, type=int, help="Number of places geocoded at the same time.",
+                            default = 4, dest='threads')
+        parser.add_argument(
+                            '-z', '--gazetteer', required=False, help="GeoNames gazetteer used by the Offline locator.",
+                            default = None, dest='gazetteer')
+        parser.add_argument(
+                            '-n', '--negativettl', required=False, type=float, help="Days before places that couldn't be geocoded are tried again.",
+                            default = 30, dest='negativettl')
+        parser.add_argument(
+                            '--stubfixture', required=False, help="Fixture of place<TAB>latitude<TAB>longitude lines for the Stub locator.",
+                            default = None, dest='stubfixture')
+        parser.add_argument(
+                            '--stublatency', required=False, type=float, help="Seconds the Stub locator takes to answer.",
+                            default = 0.0, dest='stublatency')
+        parser.add_argument(
+                            '--stuberrors', required=False, type=float, help="Fraction of requests the Stub locator fails.",
+                            default = 0.0, dest='stuberrors')
+        parser.add_argument(
+                            '--stubrate', required=False, type=float, help="Requests per second the Stub locator allows.",
+                            default = None, dest='stubrate')
+        parser.add_argument(
+                            '-u', '--budget', required=False, type=float, help="Seconds allowed for geocoding, after which only the cache and secondary locator are used.",
+                            default = None, dest='budget')
+        parser.add_argument(
+                            '-r', '--retries', required=False, type=int, help="Times a request refused by the locator's rate limit is retried.",
+                            default = 3, dest='retries')
+        parser.add_argument(
+                            '-s', '--secondary', required=False, help="Locator used when the Geocoding Locator fails or the budget runs out.",
+                            default = None, dest='secondary')
+        parser.add_argument(
+                            '-m', '--similarity', required=False, type=float, help="How similar a cached place must be to stand in for a misspelt place, from 0 to 1. 1 turns this off.",
+                            default = 0.85, dest='similarity')
 
         parser.parse_args(namespace=self)
+        if self.placecache is None:
+            self.placecache = os.path.join(os.path.dirname(self.filename), 'placecache.sqlite')
+        if self.gazetteer is None:
+            self.gazetteer = os.path.join(os.path.dirname(self.filename), 'allCountries.txt')
 
 
     def print_record(self, elem):
@@ -91,104 +139,121 @@ class MyFamily:
             print elem.get_individual()
 
     def readindividuals(self, locatorname, geocodeflag, info='names'):
-        """Read and format the data for a Place for one Individual."""
-        count1 = 0
-        count2 = 0
+        """Read and format the data for the Places of all Individuals."""
+        self.indiplacelist = list(self.iterindividuals(locatorname, geocodeflag, info))
+
+    def iterindividuals(self, locatorname, geocodeflag, info='names'):
+        """Resolve every place of the file, then return an iterator over the
+        formatted rows of the Places of all Individuals. The rows are made
+        as they are read: individuals, then their events, then the events
+        with coordinates, then rows."""
         self.info = info
-        indilist = []
-        family = ''
-        #Get the standard gedcom codes
+        geocoded = self.geocodeplaces(locatorname, geocodeflag)
+        events = self.iterevents(self.g.individuals())
+        return self.iterrows(self.itergeocoded(events, *geocoded))
+
+    def geocodeplaces(self, locatorname, geocodeflag):
+        """Resolve every place of the file before reading the events: from
+        the place cache in one go, then geocoding the rest together. Returns
+        the key of each place, the position of each key and the set of keys
+        located approximately."""
+        placedict = codesdict.PlaceCache(self.placecache, locatorname, self.negativettl * 86400,
+                                         similarity=self.similarity)
+        placekeys = self.normaliseplaces(self.readplaces())
+        placedict.prefetch(placekeys.itervalues())
+        stub = {'fixture': self.stubfixture, 'latency': self.stublatency,
+                'errors': self.stuberrors, 'rate': self.stubrate}
+        secondary = None
+        if self.secondary is not None:
+            secondary = initlocator(self.secondary, self.gazetteer, stub)
+        locator = initlocator(locatorname, self.gazetteer, stub, self.budget, self.retries, secondary)
+        positions = locator.geocode_many(placekeys.itervalues(), geocodeflag, placedict, self.threads)
+        print placedict
+        placedict.close()
+        return placekeys, positions, locator.approximate
+
+    def iterevents(self, individuals):
+        """Yield an (individual, given names, family name, family, date, year,
+        place, sort order, event, source) tuple for each source of an event
+        with a place."""
+        #Get the standard gedcom codes, split into sort order and text once per tag
         codedict = codesdict.KeyCodes()
         codedict.readcodes()
+        eventcodes = {}
 
         #Get the source codes and titles
         sourcedict = self.createsoucedictionary()
+        familyindex = self.g.family_index()
 
-        #Set up a dictionary for places and coordinates to reduce the amount of geocoding required
-        placedict = codesdict.PlaceCodes()
-
-        #Initialise the selected geocoding locator
-        locator = initlocator(locatorname)
-        for elem in self.g.element_list():
-            if elem.individual():
-
-                #Get read all the families into a string
-                family = ''
-                for fam in elem.families():
-                    family = family + str(fam)
-                #Regular Expression for Family tag
-                srchobj = re.search(r'F(\d{1,5})', family, flags=0)
-                if srchobj:
-                    family = (srchobj.group())
-                else:
-                    family = ''
-
-                #Get the events and dates associated with the gedcom file line
-                for elem2 in elem.children():
-                    indidate = ''
-                    indievent = ''
-                    indiyear = 0
-                    inditag = ""
-                    indiplace = ""
-                    indisource = ""
-                    ll = ()
-                    for elem3 in elem2.children():
-                        if elem3.date():
-                            indidate = elem3.value()
-                            #Get the year
-                            srchobj = re.search(r'\d{4}', indidate, flags=0)
-                            if srchobj:
-                                indiyear = int(srchobj.group())
-                            else:
-                                indiyear = 0
-                            #Get the place and geocode it
-
-                        if elem3.place():
-                            #Check the Places Dictionary to see if it has already been looked-up
-                            indiplace = elem3.value()
-                            coords = placedict.lookupplace(indiplace)
-                            if cmp(coords, [0,0]):
-                                count1 += 1
-                                #Place not found,  Coords 0,0 returned. Geocode for the longitude and Latitude
-                                position = locator.geocode(indiplace, geocodeflag)
-                                latitude = position[0]
-                                longitude = position[1]
-                                #Store in the dictionary
-                                placedict.addcode(indiplace, [latitude,longitude])
-
-                            else:
-                                #Place already in dictionary
-                                count2 += 1
-                                latitude,longitude = coords
-
-                            #Get the event code
-                            event = str(elem3.parent()).split(' ')[1]
-                            indievent = codedict.lookupcode(event).split(" ",1)[1]
-
-                        if elem3.source():
-                            indisource = sourcedict.get(elem3.value(), "Unknown")
-
-                            ##famsortorder = elem.family().replace('F','').zfill(5)
-                            indisortorder = elem.indi().replace('P','').zfill(5)
-                            sortorder = int(codedict.lookupcode(event).split(" ")[0])
-                            if indiplace <> "":
-                                indilist.append(tuple([longitude, latitude, elem.indi(), elem.name()[0], elem.name()[1], family, indidate, indiyear, indiplace, indievent, indisource, longitude, latitude, indisortorder, sortorder]))
-
-        pass
-        print count1
-        print count2
-        self.indiplacelist = indilist
+        for elem in individuals:
+            (first, last) = elem.name()
+
+            #The first family in which the individual is a spouse
+            family = ''
+            for fam in familyindex.spouse_families(elem.pointer()):
+                family = fam.strip('@')
+                break
+
+            for event in elem.events():
+                if event.place and event.sources:
+                    code = eventcodes.get(event.tag)
+                    if code is None:
+                        (sortorder, indievent) = codedict.lookupcode(event.tag).split(" ", 1)
+                        code = eventcodes[event.tag] = (int(sortorder), indievent)
+                    for source in event.sources:
+                        yield (elem, first, last, family, event.date, event.year, event.place,
+                               code[0], code[1], sourcedict.get(source, "Unknown"))
+
+    def itergeocoded(self, events, placekeys, positions, approximate):
+        """Yield each event with the (latitude, longitude) of its place, and
+        whether the place was located approximately."""
+        for event in events:
+            placekey = placekeys[event[6]]
+            latitude, longitude = positions[placekey]
+            yield event + (latitude, longitude, placekey in approximate)
+
+    def iterrows(self, geocoded):
+        """Yield the formatted row of each geocoded event, sorted by year and
+        event within each individual."""
+        rows = []
+        current = None
+        for (elem, first, last, family, indidate, indiyear, indiplace, sortorder, indievent, indisource,
+             latitude, longitude, approximate) in geocoded:
+            if elem is not current:
+                for row in sorted(rows, key=lambda row: (row[7], row[14])):
+                    yield row
+                rows = []
+                current = elem
+            ##famsortorder = elem.family().replace('F','').zfill(5)
+            indisortorder = elem.indi().replace('P','').zfill(5)
+            rows.append(tuple([longitude, latitude, elem.indi(), first, last, family, indidate, indiyear, indiplace,
+                               indievent, indisource, longitude, latitude, indisortorder, sortorder,
+                               'Yes' if approximate else 'No']))
+        for row in sorted(rows, key=lambda row: (row[7], row[14])):
+            yield row
+
+    def normaliseplaces(self, places):
+        """Return a dictionary of the normalised key of each place."""
+        normaliser = geocodeplace.PlaceNormaliser()
+        if self.abbreviations is not None:
+            normaliser.readabbreviations(self.abbreviations)
+        return normaliser.normaliseall(places)
+
+    def readplaces(self):
+        """Return the set of places of the events of all individuals."""
+        places = set()
+        for elem in self.g.individuals():
+            for elem2 in elem.children():
+                for elem3 in elem2.children_by_tag("PLAC"):
+                    places.add(elem3.value())
+        return places
 
     def createsoucedictionary(self):
                 #Read souce codes and titles into dictionary
         sourcedict ={}
-        for elem in self.g.element_list():
-            if elem.source() and elem.level() == 0:
-                x = elem.source()
-                if not sourcedict.has_key(elem.value):
-                    for elem2 in elem.children():
-                        if elem2.title():
-                            sourcedict[elem.pointer()] = elem2.value().decode('ascii', 'ignore')
+        for elem in self.g.sources():
+            for elem2 in elem.children_by_tag("TITL"):
+                sourcedict[elem.pointer()] = elem2.value()
         return sourcedict
 
 def createfilename(seedname, appflag):
@@ -212,36 +277,25 @@ def createfilename(seedname, appflag):
             resultname = os.path.join(foldername, filename + "_" + str(inc) + os.extsep +extension)
         return resultname
 
-def initlocator(locatorname):
+def initlocator(locatorname, gazetteer=None, stub=None, budget=None, retries=3, secondary=None):
     """Initialise the locator."""
-    locator = geocodeplace.GEOCODEPLAC(locatorname)
+    locator = geocodeplace.GEOCODEPLAC(locatorname, gazetteer=gazetteer, stub=stub, budget=budget,
+                                       retries=retries, secondary=secondary)
     return locator
 
 def writetofc(fcname, outputlist, headingslist, spatialref, appflag):
-    """Writes data stored as tuples to an ArcGIS Table."""
-    cols = len(outputlist[0])
-    dts = list()
-    dtt = tuple()
-    cols = len(outputlist[0])
-    maxlen = maxitemlength(outputlist)
-
-    #Format the constructed array
-    for col in range(cols):
-        desclist = headingslist[col]
-        typlist = "|S"+str(maxlen[col])
-        if desclist == 'Latitude' or desclist == 'Longitude':
-            typlist = "<f8"
-        elif desclist == "Year":
-            typlist = numpy.int32
-        dtt = desclist, typlist
-        dts.append(dtt)
-    inarray = numpy.array(outputlist, numpy.dtype(dts))
+    """Writes data stored as tuples to an ArcGIS Table. KML is written as
+    the rows arrive, so outputlist may be any iterator of rows."""
+    if appflag != 'Feature Class':
+        kmlgedcom.writekmlrows(outputlist, headingslist, fcname)
+        return
+    #Collect the rows into typed columns sized as they arrive
+    table = eventtable.EventTable(headingslist)
+    table.extend(outputlist)
+    inarray = table.array()
     inarray.sort(order=['IndiSortOrder', 'Year', 'YearSortOrder'])
-    if appflag == 'Feature Class':
     #arcpy.da.NumPyArrayToTable(inarray, fcname)
-        arcpy.da.NumPyArrayToFeatureClass(inarray, fcname, ("Long", "Lat"), spatialref)
-    else:
-        kmlgedcom.writekml(inarray, fcname)
+    arcpy.da.NumPyArrayToFeatureClass(inarray, fcname, ("Long", "Lat"), spatialref)
     return
 
 def headings():
@@ -262,30 +316,14 @@ def headings():
     myheadings.append("Latitude")
     myheadings.append("IndiSortOrder")
     myheadings.append("YearSortOrder")
+    myheadings.append("Approximate")
     return myheadings
 
-def maxitemlength(arr):
-    """Determines the maximum length of columnar data for creating the attribute fields."""
-    maxlenlist = []
-    maxlen = 0
-    rows = len(arr)
-    cols = len(arr[0])
-    for col in xrange(cols):
-        for row in xrange(rows):
-            maxlen = max(maxlen, len(str(arr[row][col])))
-        maxlenlist.append(roundup(maxlen))
-        maxlen = 0
-    return maxlenlist
-
-def roundup(num):
-    """Returns an integer rounded up."""
-    return int(math.ceil(num / 5.0)) * 5
-
 def main():
     #parse_options()
     """Handles the reading, writing and geocoding of the GEDCOM file data."""
     individuals = MyFamily()
-    individuals.readindividuals(individuals.locator, individuals.geocodeflag)
+    rows = individuals.iterindividuals(individuals.locator, individuals.geocodeflag)
 
     #Get a unique filename for the output.
     if individuals.appflag == "Feature Class":
@@ -295,7 +333,7 @@ def main():
     address = createfilename(seedfilename, individuals.appflag)
 
     #Write the ArcGIS Feature Class
-    writetofc(address, individuals.indiplacelist, headings(), individuals.spatialref, individuals.appflag)
+    writetofc(address, rows, headings(), individuals.spatialref, individuals.appflag)
 
 
 if __name__ == '__main__':
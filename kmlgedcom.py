@@ -8,41 +8,55 @@
 # Copyright:   (c) Janet 2015
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
-from simplekml import Kml, Style
-import numpy
 from random import randint
+from xml.sax.saxutils import escape
 
-def writekml(inarray, kmlfilename):
-    kml = Kml()
-    sharedstyle = Style()
-    sharedstyle.iconstyle.icon.href = 'http://maps.google.com/mapfiles/kml/paddle/wht-blank.png'
-    sharedstyle.iconstyle.color = "ffffffff"
-    sharedstyle.iconstyle.ColorMode = "random"
-
-    for indiv in numpy.nditer(inarray):
-        desc = adddescription(indiv)
-        lat =float(indiv[()]['Lat'])
-        lon =float(indiv[()]['Long'])
-        pnt = kml.newpoint(name=str(indiv[()]['GivenNames']) + " " +str(indiv[()]['FamilyName']), description=desc,
-            coords = [(lon,lat)])
-        pnt.style = sharedstyle
-    kml.save(kmlfilename)
-
-def adddescription(indiv):
+ICON = 'http://maps.google.com/mapfiles/kml/paddle/wht-blank.png'
+
+KMLHEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+             '<Document>\n'
+             '<Style id="sharedstyle"><IconStyle><color>ffffffff</color>'
+             '<Icon><href>' + ICON + '</href></Icon></IconStyle></Style>\n')
+
+KMLPLACEMARK = ('<Placemark><name>%s</name><description>%s</description><styleUrl>#sharedstyle</styleUrl>'
+                '<Point><coordinates>%s,%s,0.0</coordinates></Point></Placemark>\n')
+
+KMLFOOTER = '</Document>\n</kml>\n'
+
+def writekmlrows(rows, headingslist, kmlfilename):
+    """Writes each row to the KML file as it arrives, as a point named
+    after the individual with a description of the event."""
+    with open(kmlfilename, 'w') as fkml:
+        fkml.write(KMLHEADER)
+        for row in rows:
+            indiv = dict(zip(headingslist, row))
+            fkml.write(KMLPLACEMARK % (escape(str(indiv['GivenNames']) + " " + str(indiv['FamilyName'])),
+                                       describe(indiv), float(indiv['Long']), float(indiv['Lat'])))
+        fkml.write(KMLFOOTER)
+
+def describe(indiv):
+    """Returns the description of a point from a dictionary of its fields."""
     description =  ("<![CDATA[<html><body>"
                     "<body style='margin:0px 0px 0px 0px;overflow:auto;background:#FFFFFF;'>"
                     "<table style = 'font-family:Arial,Verdana,Times;font-size:12px;text-align:"
                     "left;width:100%;border-spacing:0px; padding:3px 3px 3px 3px'>"
-                    "<tr><td>Name</td><td>" + str(indiv[()]['GivenNames']) + " "  + str(indiv[()]['FamilyName']) + "</td></tr>"
-                    "<tr bgcolor='#D4E4F3'> <td>Event</td> <td>" + str(indiv[()]['Event']) + "</td></tr>"
-                    "<tr><td>Date</td> <td>" + str(indiv[()]['Date']) + "</td></tr>"
-                    "<tr><td>Place</td> <td>" + str(indiv[()]['Place']) + "</td></tr>"
-                    "<tr><td>Source</td> <td>" + str(indiv[()]['Source']) + "</td></tr>"
+                    "<tr><td>Name</td><td>" + str(indiv['GivenNames']) + " "  + str(indiv['FamilyName']) + "</td></tr>"
+                    "<tr bgcolor='#D4E4F3'> <td>Event</td> <td>" + str(indiv['Event']) + "</td></tr>"
+                    "<tr><td>Date</td> <td>" + str(indiv['Date']) + "</td></tr>"
+                    "<tr><td>Place</td> <td>" + str(indiv['Place']) + approximatenote(indiv) + "</td></tr>"
+                    "<tr><td>Source</td> <td>" + str(indiv['Source']) + "</td></tr>"
                     "</table>"
                     "</body>"
                     "</html>]]>")
     return description
 
+def approximatenote(indiv):
+    """Returns a note for places located from a similarly named place."""
+    if str(indiv.get('Approximate')) == 'Yes':
+        return " (located approximately)"
+    return ""
+
 
 def main():
     pass
@@ -0,0 +1,110 @@
+"""
+-------------------------------------------------------------------------------
+ Name:      stublocator.py
+ Purpose:   Module with a stand-in for the network geocoding services, so the
+            pipeline can be run and timed on a machine without access to them.
+
+            The stand-in has the geopy geocode interface.  It answers from a
+            fixture file of place<TAB>latitude<TAB>longitude lines or, without
+            one, with coordinates derived from the place name.  Its latency,
+            error rate and request rate limit can be set, and it raises the
+            geopy exceptions a real service would.
+
+ Author:    agent
+
+ Created:   18/10/2026
+ Copyright: (c) agent 2026
+ Licence:   This work is licensed under the Creative Commons Attribution-NonCommercial 4.0
+            International License. To view a copy of this license,
+            visit http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
+            Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+------------------------------------------------------------------------------
+"""
+#Standard Modules
+import random
+import threading
+import time
+import zlib
+#Project Modules
+from gazetteer import Location
+from geocodeplace import GeocoderQuotaExceeded, GeocoderServiceError
+
+
+class StubGeocoder(object):
+    """A locator with the geopy geocode interface that answers locally."""
+
+    def __init__(self, fixture=None, latency=0.0, errors=0.0, rate=None, seed=0):
+        """Read the fixture, if any, and set the latency in seconds, the
+        fraction of requests that fail and the requests allowed per second."""
+        self.places = None
+        if fixture is not None:
+            self.places = self.readfixture(fixture)
+        self.latency = latency
+        self.errors = errors
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = 0
+        self.count = 0
+        self.requests = 0
+        self.failures = 0
+        self.refusals = 0
+
+    def readfixture(self, fixture):
+        """Return a dictionary of the (latitude, longitude) of each place in
+        a fixture file, keyed by the place in lower case."""
+        places = {}
+        with open(fixture) as ffixture:
+            for line in ffixture:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3:
+                    places[fields[0].strip().lower()] = (float(fields[1]), float(fields[2]))
+        return places
+
+    def position(self, query):
+        """Return the (latitude, longitude) of a place, or None if it isn't
+        in the fixture."""
+        if self.places is not None:
+            return self.places.get(query.strip().lower())
+        code = zlib.crc32(query.strip().lower()) & 0xffffffff
+        return ((code % 18000) / 100.0 - 90, (code / 18000 % 36000) / 100.0 - 180)
+
+    def geocode(self, query, timeout=None):
+        """Return the Location of a place after the latency, or None if it
+        isn't known. Raises GeocoderQuotaExceeded when requests come faster
+        than the rate, and GeocoderServiceError for the given fraction of
+        requests."""
+        with self.lock:
+            self.requests += 1
+            if self.rate is not None:
+                window = int(time.time())
+                if window != self.window:
+                    self.window = window
+                    self.count = 0
+                self.count += 1
+                if self.count > self.rate:
+                    self.refusals += 1
+                    raise GeocoderQuotaExceeded("Rate limit of %s requests per second exceeded" % self.rate)
+            failed = self.random.random() < self.errors
+            if failed:
+                self.failures += 1
+        time.sleep(self.latency)
+        if failed:
+            raise GeocoderServiceError("Service unavailable")
+        position = self.position(query)
+        if position is None:
+            return None
+        return Location(query, position[0], position[1])
+
+    def __str__(self):
+        """Return the counts of requests made to the stand-in"""
+        return "Stub locator: %d requests, %d failed, %d refused" % (
+            self.requests, self.failures, self.refusals)
+
+
+def main():
+    """Main function."""
+    pass
+
+if __name__ == '__main__':
+    main()